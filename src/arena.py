@@ -0,0 +1,193 @@
+from array import array
+from bisect import bisect_left
+from tokens import Token, TokenBuffer
+import ast
+
+# Node types stored in an arena, by kind id
+node_kinds = (
+    ast.ExprStmt, ast.Declaration, ast.Assignment, ast.Return, ast.Block, ast.Function, ast.If,
+    ast.Empty, ast.Literal, ast.Variable, ast.Group, ast.Binary, ast.Unary, ast.Args, ast.Call,
+)
+kind_ids = {k: i for i, k in enumerate(node_kinds)}
+
+# Rebuilds a node of each kind from its children and its value
+builders = {
+    ast.ExprStmt:    lambda kids, value: ast.ExprStmt(*kids),
+    ast.Declaration: lambda kids, value: ast.Declaration(value, *kids),
+    ast.Assignment:  lambda kids, value: ast.Assignment(*kids),
+    ast.Return:      lambda kids, value: ast.Return(*kids),
+    ast.Block:       lambda kids, value: ast.Block(kids),
+    ast.Function:    lambda kids, value: ast.Function(*value[:3], *kids, value[3]),
+    ast.If:          lambda kids, value: ast.If(*kids),
+    ast.Empty:       lambda kids, value: ast.Empty(),
+    ast.Literal:     lambda kids, value: ast.Literal(value),
+    ast.Variable:    lambda kids, value: ast.Variable(value),
+    ast.Group:       lambda kids, value: ast.Group(*kids),
+    ast.Binary:      lambda kids, value: ast.Binary(*kids, value),
+    ast.Unary:       lambda kids, value: ast.Unary(*kids, value),
+    ast.Args:        lambda kids, value: ast.Args(kids),
+    ast.Call:        lambda kids, value: ast.Call(*kids),
+}
+
+# Columnar syntax tree. Nodes are integer handles into flat arrays, stored
+# in pre-order, so the subtree of a node is a contiguous range of handles
+# and a pass over all nodes is a loop over the arrays. Children are linked
+# through first_child and next_sibling (-1 for none), and top level
+# statements are the siblings of the first node, with parent -1. The token
+# of a node is an index into the TokenBuffer of its file, and the Token is
+# created again when the value is read. Functions also have an index into
+# values, holding their name, return type and params with token indices.
+# Apart from the buffer, arenas only hold arrays and lists, so they pickle
+# cheaply.
+class Arena:
+    def __init__(self, tokens: TokenBuffer):
+        self.tokens = tokens
+        self.kinds = array("B")
+        self.first_child = array("i")
+        self.next_sibling = array("i")
+        self.parents = array("i")
+        self.token_ids = array("i")
+        self.value_ids = array("i")
+        self.type_ids = array("i")
+        self.line_nos = array("I")
+        self.starts = array("I")
+        self.stops = array("I")
+        self.table_ids = array("i")
+        self.values = []
+        self.types = []
+        self.tables = []
+
+    # Adds a node after the last child of its parent and returns its handle.
+    # Nodes must be added in pre-order.
+    def add(self, node: ast.ParseNode, parent: int, prev: int, value: object = None) -> int:
+        h = len(self.kinds)
+        self.kinds.append(kind_ids[type(node)])
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.parents.append(parent)
+        if type(value) == tuple:
+            name, params, return_t, ident = value
+            self.token_ids.append(self.token_id(ident))
+            self.value_ids.append(len(self.values))
+            self.values.append((name, [(p.name, p.type, self.token_id(p.token)) for p in params], return_t))
+        else:
+            self.token_ids.append(self.token_id(value))
+            self.value_ids.append(-1)
+        self.type_ids.append(self.store(self.types, node.type))
+        self.line_nos.append(node.line)
+        self.starts.append(node.start)
+        self.stops.append(node.stop)
+        self.table_ids.append(self.store(self.tables, node.lines))
+
+        if prev != -1:
+            self.next_sibling[prev] = h
+        elif parent != -1:
+            self.first_child[parent] = h
+        return h
+
+    # Index of a type or line table, -1 for None. These are usually shared
+    # between neighbouring nodes, so the last one is reused.
+    def store(self, values: list, value: object) -> int:
+        if value is None:
+            return -1
+        if not values or values[-1] is not value:
+            values.append(value)
+        return len(values) - 1
+
+    # Index of a token in the buffer, found by its source offset. -1 for None.
+    def token_id(self, tok: Token) -> int:
+        if tok is None:
+            return -1
+        buf = self.tokens
+        i = bisect_left(buf.starts, buf.lines.offset(tok.line, tok.col))
+        if i == len(buf) or buf.types[i] != tok.type:
+            raise ValueError(f"token '{tok.lexeme}' at line {tok.line} is not in the buffer")
+        return i
+
+    def token(self, i: int) -> Token:
+        return None if i == -1 else self.tokens.token(i)
+
+    def kind(self, handle: int) -> type:
+        return node_kinds[self.kinds[handle]]
+
+    # Token of a node, or name, params, return type and name token of a
+    # function, as they were added
+    def value(self, handle: int) -> object:
+        i = self.value_ids[handle]
+        tok = self.token(self.token_ids[handle])
+        if i == -1:
+            return tok
+        name, params, return_t = self.values[i]
+        return (name, [ast.Param(n, t, self.token(k)) for n, t, k in params], return_t, tok)
+
+    def type(self, handle: int) -> ast.Type:
+        i = self.type_ids[handle]
+        return None if i == -1 else self.types[i]
+
+    # Handles of the children of a node, or of the top level statements
+    def children(self, handle: int = -1):
+        child = self.first_child[handle] if handle != -1 else (0 if len(self) else -1)
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    # Handles of a subtree in pre-order, or of all nodes
+    def walk(self, handle: int = -1):
+        if handle == -1:
+            return iter(range(len(self)))
+        return iter(range(handle, self.end(handle)))
+
+    # Handle after the last node of a subtree
+    def end(self, handle: int) -> int:
+        while handle != -1:
+            if self.next_sibling[handle] != -1:
+                return self.next_sibling[handle]
+            handle = self.parents[handle]
+        return len(self)
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+    # Rebuilds the object tree. Children have larger handles than their
+    # parents, so nodes are built from the last handle to the first.
+    def to_tree(self) -> ast.AstNode:
+        nodes = [None] * len(self)
+        for h in range(len(self) - 1, -1, -1):
+            kids = [nodes[c] for c in self.children(h)]
+            node = builders[self.kind(h)](kids, self.value(h))
+            node.type = self.type(h)
+            node.line = self.line_nos[h]
+            node.start = self.starts[h]
+            node.stop = self.stops[h]
+            t = self.table_ids[h]
+            node.lines = None if t == -1 else self.tables[t]
+            nodes[h] = node
+
+        tree = ast.AstNode()
+        tree.stmts = [nodes[h] for h in self.children()]
+        return tree
+
+# Converts an object tree to an arena. The tokens of the tree must come from
+# the buffer it was parsed from. Function bodies are parsed if they were
+# deferred.
+def to_arena(tree: ast.AstNode, tokens: TokenBuffer) -> Arena:
+    arena = Arena(tokens)
+    # Last child added to each parent
+    last = {}
+    stack = [(node, -1) for node in reversed(tree.stmts)]
+    while stack:
+        node, parent = stack.pop()
+        h = arena.add(node, parent, last.get(parent, -1), node_value(node))
+        last[parent] = h
+
+        for child in reversed(ast.children(node)):
+            stack.append((child, h))
+
+    return arena
+
+def node_value(node: ast.ParseNode) -> object:
+    if type(node) == ast.Function:
+        return (node.name, node.params, node.return_t, node.ident)
+    for name in ast.token_fields.get(type(node), ()):
+        return getattr(node, name)
+    return None
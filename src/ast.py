@@ -1,198 +1,161 @@
+import sys
 from tokens import *
+import stats
 
 class Type:
+    __slots__ = ("type", "user_def", "string", "kind")
+
     def __init__(self, typ: str, user_def: bool = False) -> None:
         self.type = typ
         self.user_def = user_def
         self.string = typ
         if not user_def:
-            self.kind = type_to_kind[typ]
+            self.kind = type_to_kind.get(typ, KIND_NONE)
         else:
             self.kind = KIND_NONE
 
 class Param:
-    def __init__(self, name: str, typ: Type):
+    __slots__ = ("name", "type", "token")
+
+    def __init__(self, name: str, typ: Type, token: Token = None):
         self.name = name
         self.type = typ
+        self.token = token # Name token, for diagnostics
 
 class AstNode:
     def __init__(self):
         self.stmts = []
-        self.indent = 0
-
-    # Todo: rewrite syntax tree print function
-    def print(self):
-        for node in self.stmts:
-            self.indent = -1
-            if s := self.string_node(node):
-                print(s)
-
-    def print_block(self, block):
-        for node in block.stmts:
-            s = self.string_node(node)
-            print(s, end="" if s == "" else "\n")
-
-    def concat(self, title: str, suffix: str, end: str = "\n") -> str:
-        if suffix == "": end = ""
-        return f"{self.indent*'| '}{title}: {end}{suffix}"
-
-    def indent_wrap(func):
-        def wrap(self, node):
-            self.indent += 1
-            s = func(self, node)
-            self.indent -= 1
-            return s
-
-        return wrap
-
-    @indent_wrap
-    def string_node(self, node) -> str:
-        t = type(node)
-        if t == ExprStmt:
-            if type(node.expr) == Empty:
-                return ""
-            return self.concat("ExprStmt", self.string_node(node.expr))
-
-        elif t == Block:
-            print(self.concat("Block", "", ""))
-            self.print_block(node)
-            return ""
-
-        elif t == Function:
-            s = ""
-            for p in node.params:
-                s += f"{p.name}: {p.type.string}, "
-            s = "(" + s[:len(s)-2] + ")"
-            if node.return_t:
-                s += f": {node.return_t.string}"
-
-            func = self.concat(f"Function {node.name}", s, "")
-            print(func)
-            self.print_block(node.body)
-            return ""
-
-        elif t == If:
-            print(self.concat("If", "", ""))
-            print(self.concat(".expr", self.string_node(node.expr)))
-            print(".block:")
-            self.print_block(node.block)
-            return ""
-        
-        elif t == Declaration:
-            self.indent += 1
-            name = self.concat(".name", node.ident.lexeme, "")
-            expr = self.concat(".expr", self.string_node(node.expr))
-            self.indent -= 1
-            return self.concat("Declaration", f"{name}\n{expr}")
-
-        elif t == Assignment:
-            self.indent += 1
-            left = self.concat(".left", self.string_node(node.left))
-            expr = self.concat(".expr", self.string_node(node.expr))
-            self.indent -= 1
-            return self.concat("Assignment", f"{left}\n{expr}")
-
-        elif t == Return:
-            return self.concat("Return", self.string_node(node.expr))
-        
-        elif t == Literal:
-            return self.concat("Literal", node.token.lexeme, "")
-
-        elif t == Variable:
-            return self.concat("Variable", node.token.lexeme, "")
-        
-        elif t == Group:
-            return self.concat("Group", self.string_node(node.inner))
-
-        elif t == Binary:
-            self.indent += 1
-            left  = self.concat(".left", self.string_node(node.left))
-            right = self.concat(".right", self.string_node(node.right))
-            op    = self.concat(".op", node.op.lexeme, "")
-            self.indent -= 1
-            return self.concat("Binary", f"{op}\n{left}\n{right}")
-
-        elif t == Unary:
-            self.indent += 1
-            op   = self.concat("op", node.op.lexeme, "")
-            expr = self.concat(".expr", self.string_node(node.expr))
-            self.indent -= 1
-            return self.concat("Unary", f"{op}\n{expr}")
-
-        elif t == Args:
-            self.indent += 1
-            args = []
-            for a in node.args:
-                args.append(self.string_node(a))
-            self.indent -= 1
-            return self.concat("Args", "\n".join(args))
-
-        elif t == Call:
-            self.indent += 1
-            callee = self.concat(".callee", self.string_node(node.callee))
-            inner  = self.concat(".inner", self.string_node(node.inner))
-            self.indent -= 1
-            return self.concat("Call", f"{callee}\n{inner}")
-
-        return ""
 
+    # Writes the tree to out, standard output by default
+    def print(self, out=None):
+        with stats.phase("print"):
+            printer = TreePrinter(out or sys.stdout)
+            printer.walk(self.stmts)
+            printer.flush()
+            if stats.enabled:
+                stats.count("ast.printed", printer.printed)
+
+# Nodes use slots and refer to the line table of their tokens instead of
+# copying the line text, so a node holds no per-instance dict.
 class ParseNode:
+    __slots__ = ("signature", "type", "line", "start", "stop", "lines")
+
     def __init__(self, *args):
-        self.signature = Signature(self)
+        self.signature = Signature(type(self).__name__)
         for a in args:
             self.signature.add(a)
         self.type = None
         self.line = 0
         self.start = 0
         self.stop = 0
-        self.string = ""
+        self.lines = None
+
+    # Line the node starts at as a string
+    @property
+    def string(self) -> str:
+        if self.lines is None:
+            return ""
+        return self.lines.text(self.line)
 
 class Stmt(ParseNode):
+    __slots__ = ()
+
     def __init__(self, *args):
         super().__init__(*args)
 
 class Expr(ParseNode):
+    __slots__ = ()
+
     def __init__(self, *args):
         super().__init__(*args)
 
 # ------------ STATEMENTS ------------ 
 
 class ExprStmt(Stmt):
+    __slots__ = ("expr",)
+
     def __init__(self, expr: Expr):
         super().__init__(expr)
         self.expr = expr
 
 class Declaration(Stmt):
+    __slots__ = ("ident", "expr")
+
     def __init__(self, ident: Token, expr: Expr):
         super().__init__(ident, expr)
         self.ident = ident
         self.expr = expr
 
 class Assignment(Stmt):
+    __slots__ = ("left", "expr")
+
     def __init__(self, left: Expr, expr: Expr):
         super().__init__(left, expr)
         self.left = left
         self.expr = expr
 
 class Return(Stmt):
+    __slots__ = ("expr",)
+
     def __init__(self, expr: Expr):
         super().__init__(expr)
         self.expr = expr
 
 class Block(Stmt):
+    __slots__ = ("stmts",)
+
     def __init__(self, stmts: list[Stmt]):
         super().__init__(stmts)
         self.stmts = stmts
 
+# Handle for a node that is parsed when it is first needed
+class Deferred:
+    __slots__ = ("parse", "_node")
+
+    def __init__(self, parse):
+        self.parse = parse
+        self._node = None
+
+    @property
+    def node(self) -> ParseNode:
+        if self._node is None:
+            self._node = self.parse()
+        return self._node
+
+    @property
+    def signature(self) -> Signature:
+        return self.node.signature
+
 class Function(Stmt):
-    def __init__(self, name: str, params: list[Param], return_t: Type, body: Block):
+    __slots__ = ("name", "params", "return_t", "_body", "ident")
+
+    def __init__(self, name: str, params: list[Param], return_t: Type, body: Block | Deferred, ident: Token = None):
         super().__init__(name, params, return_t, body)
         self.name = name
         self.params = params
         self.return_t = return_t
-        self.body = body
+        self._body = body
+        self.ident = ident # Name token, for diagnostics
+
+    # Function body, parsed on first access if deferred
+    @property
+    def body(self) -> Block:
+        if type(self._body) == Deferred:
+            self._body = self._body.node
+        return self._body
+
+    @body.setter
+    def body(self, body: Block):
+        self._body = body
+
+    # If the body has been parsed
+    @property
+    def parsed(self) -> bool:
+        return type(self._body) != Deferred or self._body._node is not None
 
 class If:
+    __slots__ = ("expr", "block")
+
     def __init__(self, expr: Expr, block: Block) -> None:
         super().__init__(expr, block)
         self.expr = expr
@@ -204,24 +167,32 @@ def is_empty(expr: Expr) -> bool:
     return type(expr) == type(Empty())
 
 class Empty(Expr):
-    pass
+    __slots__ = ()
 
 class Literal(Expr):
+    __slots__ = ("token",)
+
     def __init__(self, tok: Token):
         super().__init__(tok)
         self.token = tok
 
 class Variable(Expr):
+    __slots__ = ("token",)
+
     def __init__(self, tok: Token):
         super().__init__(tok)
         self.token = tok
 
 class Group(Expr):
+    __slots__ = ("inner",)
+
     def __init__(self, inner: Expr):
         super().__init__(inner)
         self.inner = inner
 
 class Binary(Expr):
+    __slots__ = ("left", "right", "op")
+
     def __init__(self, left: Expr, right: Expr, op: Token):
         super().__init__(left, right, op)
         self.left = left
@@ -229,19 +200,288 @@ class Binary(Expr):
         self.op = op
 
 class Unary(Expr):
+    __slots__ = ("expr", "op")
+
     def __init__(self, expr: Expr, op: Token):
         super().__init__(expr, op)
         self.expr = expr
         self.op = op
 
 class Args(Expr):
+    __slots__ = ("args",)
+
     def __init__(self, args: list[Expr]):
         super().__init__(args)
         self.args = args
 
 class Call(Expr):
+    __slots__ = ("callee", "inner")
+
     def __init__(self, callee: Expr, inner: Expr):
         super().__init__(callee, inner)
         self.callee = callee
         self.inner = inner
 
+# ------------- FIELDS ---------------
+
+# Child node fields of each node type, in signature order
+node_fields = {
+    ExprStmt: ("expr",),
+    Declaration: ("expr",),
+    Assignment: ("left", "expr"),
+    Return: ("expr",),
+    Block: ("stmts",),
+    Function: ("body",),
+    If: ("expr", "block"),
+    Group: ("inner",),
+    Binary: ("left", "right"),
+    Unary: ("expr",),
+    Args: ("args",),
+    Call: ("callee", "inner"),
+}
+
+# Token fields of each node type
+token_fields = {
+    Declaration: ("ident",),
+    Literal: ("token",),
+    Variable: ("token",),
+    Binary: ("op",),
+    Unary: ("op",),
+}
+
+# Shallow size of a node in bytes: the node, its signature and the tokens
+# it holds. Shared tokens and line tables are not counted.
+def node_size(node: ParseNode) -> int:
+    size = sys.getsizeof(node) + sys.getsizeof(node.signature) + sys.getsizeof(node.signature.parts)
+    if hasattr(node, "__dict__"):
+        size += sys.getsizeof(node.__dict__)
+    for name in token_fields.get(type(node), ()):
+        size += sys.getsizeof(getattr(node, name))
+    return size
+
+# Number of nodes in a tree and their total size in bytes. Function bodies
+# that have not been parsed are not counted.
+def tree_size(tree: AstNode) -> tuple[int, int]:
+    count, size = 0, 0
+    for node in walk(tree):
+        count += 1
+        size += node_size(node)
+    return count, size
+
+# Nodes of a tree in pre-order, without recursion. Function bodies that
+# have not been parsed are skipped.
+def walk(tree: AstNode):
+    stack = list(reversed(tree.stmts))
+    while stack:
+        node = stack.pop()
+        yield node
+        if type(node) == Function and not node.parsed:
+            continue
+        stack.extend(reversed(children(node)))
+
+# Child nodes of a node in field order. Deferred function bodies are parsed.
+def children(node: ParseNode) -> list[ParseNode]:
+    kids = []
+    for name in node_fields.get(type(node), ()):
+        value = getattr(node, name)
+        if type(value) == list:
+            kids.extend(value)
+        elif value is not None:
+            kids.append(value)
+    return kids
+
+# (field, child) pairs of a node in field order, where field is an
+# attribute name or an (attribute name, index) pair for list fields.
+# Function bodies that have not been parsed are skipped.
+def child_items(node: ParseNode):
+    if type(node) == Function and not node.parsed:
+        return
+
+    for name in node_fields.get(type(node), ()):
+        value = getattr(node, name)
+        if type(value) == list:
+            for i, child in enumerate(value):
+                yield (name, i), child
+        elif value is not None:
+            yield name, value
+
+# Replaces a child of a node, in its field and in its signature
+def replace(node: ParseNode, field, old: ParseNode, new: ParseNode):
+    if type(field) == tuple:
+        getattr(node, field[0])[field[1]] = new
+    else:
+        setattr(node, field, new)
+
+    parts = node.signature.parts
+    for i, p in enumerate(parts):
+        if p is old:
+            parts[i] = new
+
+# ------------- VISITOR --------------
+
+# Walks nodes with an explicit stack, so deep trees do not hit the
+# recursion limit. Each item is dispatched on its type to visit_<Type> of
+# the subclass, which is called on the way down and returns the items to
+# walk under it, its child nodes by default. leave_<Type>, or leave_default
+# if defined, is called after everything under the item has been walked,
+# so leave methods see the items in post-order. Methods are
+# looked up once per type and kept in a table per subclass. Items do not
+# have to be nodes, any type with a visit method can be pushed.
+class Visitor:
+    methods = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.methods = {}
+
+    # Depth of the item being visited, top level items are at depth 0
+    depth = 0
+    leave_default = None
+
+    def walk(self, items: list, depth: int = 0):
+        methods = self.methods
+        # Leave entries are pushed with the depth inverted
+        stack = [(item, depth) for item in reversed(items)]
+        pop, push = stack.pop, stack.append
+        while stack:
+            item, depth = pop()
+            visit, leave = methods.get(type(item)) or self.lookup(type(item))
+            if depth < 0:
+                self.depth = ~depth
+                leave(self, item)
+                continue
+
+            self.depth = depth
+            kids = visit(self, item)
+            if leave is not None:
+                push((item, ~depth))
+            if kids:
+                depth += 1
+                for kid in reversed(kids):
+                    push((kid, depth))
+
+    # Visit and leave methods of a type, looked up once per subclass
+    def lookup(self, t: type) -> tuple:
+        cls = type(self)
+        visit = getattr(cls, f"visit_{t.__name__}", cls.visit_default)
+        cls.methods[t] = visit, getattr(cls, f"leave_{t.__name__}", cls.leave_default)
+        return cls.methods[t]
+
+    def visit_default(self, node) -> list:
+        return children(node)
+
+# Labelled field of a node for the printer. The label is printed one level
+# below the node and the field's node one level below the label. Without a
+# label only the node is printed, still two levels below.
+class Field:
+    __slots__ = ("label", "node")
+
+    def __init__(self, label: str | None, node: ParseNode):
+        self.label = label
+        self.node = node
+
+# Nodes printed as a single line with their token
+leaf_titles = {Literal: "Literal", Variable: "Variable"}
+
+# Prints a tree with one line per node and field, indented with "| " per
+# level. Lines are buffered and written to the stream in batches.
+class TreePrinter(Visitor):
+    BATCH = 4096
+
+    def __init__(self, out):
+        self.out = out
+        self.lines = []
+        self.printed = 0
+
+    def flush(self):
+        if self.lines:
+            self.out.write("\n".join(self.lines) + "\n")
+            self.lines.clear()
+
+    # Line of the node being visited
+    def node(self, title: str, text: str = ""):
+        self.printed += 1
+        self.lines.append(f"{self.depth*'| '}{title}: {text}")
+        if len(self.lines) >= self.BATCH:
+            self.flush()
+
+    # Line of a token field of the node being visited
+    def token(self, label: str, tok: Token):
+        self.lines.append(f"{(self.depth + 1)*'| '}{label}: {tok.lexeme}")
+
+    # Leaves are printed with their label instead of being walked
+    def visit_Field(self, field: Field) -> list:
+        lines, node = self.lines, field.node
+        if field.label is not None:
+            lines.append(f"{self.depth*'| '}{field.label}: ")
+        title = leaf_titles.get(type(node))
+        if title is None:
+            return [node]
+        self.printed += 1
+        lines.append(f"{(self.depth + 1)*'| '}{title}: {node.token.lexeme}")
+        return None
+
+    def visit_ExprStmt(self, node: ExprStmt) -> list:
+        if type(node.expr) == Empty:
+            return None
+        self.node("ExprStmt")
+        return [node.expr]
+
+    def visit_Block(self, node: Block) -> list:
+        self.node("Block")
+        return node.stmts
+
+    def visit_Function(self, node: Function) -> list:
+        params = ", ".join(f"{p.name}: {p.type.string}" for p in node.params)
+        ret = f": {node.return_t.string}" if node.return_t else ""
+        self.node(f"Function {node.name}", f"({params}){ret}")
+        return node.body.stmts
+
+    def visit_If(self, node: If) -> list:
+        self.node("If")
+        return [Field(".expr", node.expr), Field(".block", node.block)]
+
+    def visit_Declaration(self, node: Declaration) -> list:
+        self.node("Declaration")
+        self.token(".name", node.ident)
+        return [Field(".expr", node.expr)]
+
+    def visit_Assignment(self, node: Assignment) -> list:
+        self.node("Assignment")
+        return [Field(".left", node.left), Field(".expr", node.expr)]
+
+    def visit_Return(self, node: Return) -> list:
+        self.node("Return")
+        return [node.expr]
+
+    def visit_Empty(self, node: Empty) -> list:
+        return None
+
+    def visit_Literal(self, node: Literal) -> list:
+        self.node("Literal", node.token.lexeme)
+
+    def visit_Variable(self, node: Variable) -> list:
+        self.node("Variable", node.token.lexeme)
+
+    def visit_Group(self, node: Group) -> list:
+        self.node("Group")
+        return [node.inner]
+
+    def visit_Binary(self, node: Binary) -> list:
+        self.node("Binary")
+        self.token(".op", node.op)
+        return [Field(".left", node.left), Field(".right", node.right)]
+
+    def visit_Unary(self, node: Unary) -> list:
+        self.node("Unary")
+        self.token("op", node.op)
+        return [Field(".expr", node.expr)]
+
+    # Arguments are indented an extra level
+    def visit_Args(self, node: Args) -> list:
+        self.node("Args")
+        return [Field(None, a) for a in node.args]
+
+    def visit_Call(self, node: Call) -> list:
+        self.node("Call")
+        return [Field(".callee", node.callee), Field(".inner", node.inner)]
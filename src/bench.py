@@ -0,0 +1,292 @@
+import io
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tracemalloc
+from lexer import get_tokens, legacy_tokens, table_buffer, vector_buffer, relex
+from parser import parse_tokens
+import ast
+import util
+
+# Rates of the largest run of each corpus and stage, written with --save
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+SIZES = (1, 2, 4)   # Corpus sizes, as multiples of the base size
+REPEAT = 3          # Runs per measurement, the fastest is used
+TOLERANCE = 0.3     # Allowed slowdown from the baseline rate
+MAX_EXPONENT = 1.3  # Largest allowed growth of time with input size
+MIN_SPEEDUP = 1.0   # Lexer must not be slower than legacy_tokens
+# vector_buffer against table_buffer. Measured at 3-4x on most corpora and
+# 1.1-1.4x on comments_strings, where the string and comment masks take
+# most of the time.
+MIN_VECTOR_SPEEDUP = 0.9
+EDITS = 200         # Edits timed by edit_seconds
+MAX_EDIT_GROWTH = 2 # Largest allowed growth of edit time from the smallest to the largest size
+
+corpora = {}
+
+def corpus(func):
+    corpora[func.__name__] = func
+    return func
+
+# ---------------------- CORPORA ----------------------
+# Each generator returns a program that grows linearly with n
+
+@corpus
+def long_file(n: int) -> str:
+    lines = []
+    for i in range(1000 * n):
+        lines.append(f"v{i} := a{i % 7} * {i} + b - {i % 13}.5")
+        lines.append(f"v{i} = f(v{i}, {i}) % 3")
+    return "\n".join(lines) + "\n"
+
+@corpus
+def nested_exprs(n: int) -> str:
+    # Depth stays below what the recursive parser can handle
+    lines = []
+    for i in range(100 * n):
+        depth = 10 + i % 15
+        expr = "x"
+        for d in range(depth):
+            expr = f"({expr} + {d})" if d % 3 else f"f(-{expr}, {d})"
+        lines.append(f"r{i} := {expr}")
+    return "\n".join(lines) + "\n"
+
+@corpus
+def many_functions(n: int) -> str:
+    funcs = []
+    for i in range(200 * n):
+        funcs.append(
+            f"func f{i}(a: int, b: float): int {{\n"
+            f"\tc := a * {i} + b\n"
+            f"\t{{\n"
+            f"\t\td := f{i}(c - 1, b) >= {i}\n"
+            f"\t}}\n"
+            f"\treturn c\n"
+            f"}}\n"
+        )
+    return "".join(funcs)
+
+@corpus
+def long_args(n: int) -> str:
+    args = ", ".join(f"a{j} + {j}" for j in range(100))
+    return "".join(f"call{i}({args})\n" for i in range(50 * n))
+
+@corpus
+def comments_strings(n: int) -> str:
+    lines = []
+    for i in range(1000 * n):
+        lines.append(f'// comment {i} with "quotes" and / slashes')
+        lines.append(f's{i} := f("string {i}", "another // string") // trailing {i}')
+    return "\n".join(lines) + "\n"
+
+# ---------------------- STAGES ----------------------
+
+def lex(src: str):
+    return get_tokens(src)
+
+def parse(tokens):
+    return parse_tokens(tokens)
+
+def print_tree(tree):
+    tree.print(io.StringIO())
+    return tree
+
+stages = (("lex", lex), ("parse", parse), ("print", print_tree))
+
+# Times each stage on the source, fastest of REPEAT runs. Returns a dict of
+# stage name to (seconds, items), items is tokens for lex and nodes after.
+def time_stages(src: str) -> dict:
+    times = {name: math.inf for name, _ in stages}
+    for _ in range(REPEAT):
+        value = src
+        for name, stage in stages:
+            start = time.perf_counter()
+            value = stage(value)
+            times[name] = min(times[name], time.perf_counter() - start)
+            if name == "lex":
+                tokens = len(value)
+
+    nodes = ast.tree_size(value)[0]
+    return {name: (times[name], tokens if name == "lex" else nodes) for name, _ in stages}
+
+# Seconds legacy_tokens takes to lex the source, fastest of REPEAT runs.
+# The default lexer is compared with it on the same machine, so the check
+# does not depend on a saved baseline.
+def legacy_seconds(src: str) -> float:
+    best = math.inf
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        legacy_tokens(src)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# Seconds table_buffer and vector_buffer take to lex the source, fastest of
+# REPEAT runs each. None when numpy is missing.
+def vector_seconds(src: str) -> tuple:
+    try:
+        vector_buffer("")
+    except ImportError:
+        return None
+    best = [math.inf, math.inf]
+    for _ in range(REPEAT):
+        for i, engine in enumerate((table_buffer, vector_buffer)):
+            start = time.perf_counter()
+            engine(src)
+            best[i] = min(best[i], time.perf_counter() - start)
+    return tuple(best)
+
+# Seconds relex takes for EDITS edits in the middle of the source, fastest
+# of REPEAT runs. Every other edit undoes the one before, a space inserted
+# at the start of a line and removed again.
+def edit_seconds(src: str) -> float:
+    tokens = get_tokens(src)
+    lines = tokens[0].lines
+    offset = lines.start(len(lines) // 2)
+    best = math.inf
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(EDITS // 2):
+            relex(tokens, lines, offset, 0, " ")
+            relex(tokens, lines, offset, 1, "")
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# Peak traced memory of each stage in bytes. Traced separately from the
+# timing since tracing slows everything down.
+def peak_memory(src: str) -> dict:
+    peaks = {}
+    value = src
+    tracemalloc.start()
+    for name, stage in stages:
+        tracemalloc.reset_peak()
+        value = stage(value)
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peaks
+
+# ---------------------- RUNNER ----------------------
+
+class Result:
+    def __init__(self, corpus: str, stage: str, size: int, seconds: float, items: int, peak: int,
+            legacy: float = None, vector: tuple = None):
+        self.corpus = corpus
+        self.stage = stage
+        self.size = size
+        self.seconds = seconds
+        self.items = items
+        self.peak = peak
+        self.legacy = legacy # Seconds of legacy_tokens, lex stage only
+        self.vector = vector # Seconds of table_buffer and vector_buffer, lex stage only
+
+    @property
+    def rate(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else math.inf
+
+    @property
+    def speedup(self) -> float:
+        return self.legacy / self.seconds if self.seconds > 0 else math.inf
+
+    @property
+    def vector_speedup(self) -> float:
+        table, vector = self.vector
+        return table / vector if vector > 0 else math.inf
+
+    def __str__(self) -> str:
+        unit = {"lex": "tokens/s", "edit": "edits/s"}.get(self.stage, "nodes/s")
+        text = (f"{self.corpus:16} {self.stage:5} x{self.size:<3} {self.items:8} items "
+            f"{self.seconds*1000:9.1f} ms {self.rate:12.0f} {unit:8} {self.peak/(1<<20):8.1f} MB peak")
+        if self.legacy is not None:
+            text += f" {self.speedup:5.2f}x legacy"
+        if self.vector is not None:
+            text += f" {self.vector_speedup:5.2f}x vector"
+        return text
+
+def run(names: list[str], scale: int) -> list[Result]:
+    results = []
+    for name in names:
+        for size in SIZES:
+            src = corpora[name](size * scale)
+            peaks = peak_memory(src)
+            legacy = legacy_seconds(src)
+            vector = vector_seconds(src)
+            for stage, (seconds, items) in time_stages(src).items():
+                lex = stage == "lex"
+                r = Result(name, stage, size, seconds, items, peaks[stage], legacy if lex else None, vector if lex else None)
+                results.append(r)
+                print(r)
+
+            r = Result(name, "edit", size, edit_seconds(src), EDITS, 0)
+            results.append(r)
+            print(r)
+
+    return results
+
+# Returns failure messages for super-linear growth, for rates below the
+# baseline, for a lexer that is slower than legacy_tokens and for a vector
+# engine that is slower than table_buffer. Edits should take the same time
+# at every size.
+def check(results: list[Result], baseline: dict) -> list[str]:
+    failures = []
+    groups = {}
+    for r in results:
+        groups.setdefault((r.corpus, r.stage), []).append(r)
+
+    for (name, stage), rs in groups.items():
+        small, large = rs[0], rs[-1]
+        if small.seconds > 0 and large.items > small.items:
+            exponent = math.log(large.seconds / small.seconds) / math.log(large.items / small.items)
+            if exponent > MAX_EXPONENT:
+                failures.append(f"{name} {stage} grows as n^{exponent:.2f}")
+        if stage == "edit" and large.seconds > small.seconds * MAX_EDIT_GROWTH:
+            failures.append(f"{name} edit takes {large.seconds/small.seconds:.2f}x as long at x{large.size} as at x{small.size}")
+
+        base = baseline.get(name, {}).get(stage)
+        if base is not None and large.rate < base * (1 - TOLERANCE):
+            failures.append(f"{name} {stage} at {large.rate:.0f}/s, baseline {base:.0f}/s")
+
+        if large.legacy is not None and large.speedup < MIN_SPEEDUP:
+            failures.append(f"{name} {stage} {large.speedup:.2f}x legacy_tokens, expected {MIN_SPEEDUP}x")
+
+        if large.vector is not None and large.vector_speedup < MIN_VECTOR_SPEEDUP:
+            failures.append(f"{name} vector_buffer {large.vector_speedup:.2f}x table_buffer, expected {MIN_VECTOR_SPEEDUP}x")
+
+    return failures
+
+def load_baseline() -> dict:
+    if not os.path.exists(BASELINE):
+        return {}
+    with open(BASELINE) as f:
+        return json.load(f)
+
+def save_baseline(results: list[Result]):
+    baseline = load_baseline()
+    for r in results:
+        baseline.setdefault(r.corpus, {})[r.stage] = r.rate
+    with open(BASELINE, "w") as f:
+        json.dump(baseline, f, indent=4)
+
+if __name__ == "__main__":
+    cli = argparse.ArgumentParser(description="Lexer and parser benchmarks")
+    cli.add_argument("corpora", nargs="*", help=f"corpora to run, all by default: {', '.join(corpora)}")
+    cli.add_argument("--scale", type=int, default=1, help="multiplies every corpus size")
+    cli.add_argument("--save", action="store_true", help="store the rates as the new baseline")
+    args = cli.parse_args()
+    for name in args.corpora:
+        if name not in corpora:
+            cli.error(f"unknown corpus '{name}', choose from {', '.join(corpora)}")
+
+    results = run(args.corpora or list(corpora), args.scale)
+    if args.save:
+        save_baseline(results)
+        sys.exit(0)
+
+    failures = check(results, load_baseline())
+    for f in failures:
+        print(f"[ {util.red('fail')} ] {f}")
+    if failures:
+        sys.exit(1)
+    print(f"[ {util.green('pass')} ] no regressions")
@@ -0,0 +1,115 @@
+import os
+import io
+import pickle
+import tempfile
+from hashlib import blake2b
+from tokens import *
+import ast
+import arena
+import lexer
+import util
+
+CACHE_LIMIT = 64 << 20
+
+# On-disk cache of parsed files. A tree is stored as a pickled arena under
+# a hash of the compiler version and the source, so an unchanged file loads
+# without parsing. Tokens and line tables are not stored, the arena refers to
+# tokens by index and the source is lexed again on load, which is much
+# cheaper than parsing it. Files are written to a temporary file and renamed into
+# place, so concurrent writers and readers never see a partial entry. When
+# the cache is over its size limit the least recently used entries are
+# removed, using the file modification time, which is updated on each hit.
+class ParseCache:
+    def __init__(self, path: str, limit: int = CACHE_LIMIT):
+        self.path = path
+        self.limit = limit
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, source: str) -> str:
+        h = blake2b(util.version.encode(), digest_size=20)
+        h.update(source.encode())
+        return h.hexdigest()
+
+    def file(self, source: str) -> str:
+        return os.path.join(self.path, f"{self.key(source)}.ast")
+
+    # Returns the cached tree of the source, or None if it is not cached
+    def load(self, source: str) -> ast.AstNode | None:
+        filename = self.file(source)
+        try:
+            with open(filename, "rb") as f:
+                data = f.read()
+            os.utime(filename)
+        except OSError:
+            return None
+
+        try:
+            return TreeUnpickler(io.BytesIO(data), lexer.lex_buffer(source)).load().to_tree()
+        except Exception:
+            # Damaged entry, parse again and overwrite it
+            return None
+
+    # Stores the tree parsed from the source and its tokens, then evicts old
+    # entries
+    def store(self, source: str, tree: ast.AstNode, tokens: TokenBuffer):
+        buf = io.BytesIO()
+        TreePickler(buf).dump(arena.to_arena(tree, tokens))
+
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(buf.getvalue())
+            os.replace(tmp, self.file(source))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+
+        self.evict()
+
+    # Removes the least recently used entries until the cache fits its limit
+    def evict(self):
+        entries = []
+        for e in os.scandir(self.path):
+            if not e.name.endswith(".ast"):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.limit:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # Already removed by another process
+            total -= size
+
+# Line tables and token buffers hold the whole source, so they are stored
+# as a reference and replaced with the tokens of the current source on load
+class TreePickler(pickle.Pickler):
+    def __init__(self, file):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+
+    def persistent_id(self, obj):
+        if type(obj) == LineTable:
+            return "lines"
+        if type(obj) == TokenBuffer:
+            return "tokens"
+        return None
+
+class TreeUnpickler(pickle.Unpickler):
+    def __init__(self, file, tokens: TokenBuffer):
+        super().__init__(file)
+        self.tokens = tokens
+
+    def persistent_load(self, pid):
+        if pid == "lines":
+            return self.tokens.lines
+        if pid == "tokens":
+            return self.tokens
+        raise pickle.UnpicklingError(f"unknown persistent id {pid}")
@@ -0,0 +1,356 @@
+from hashlib import blake2b
+from tokens import *
+from error import *
+from scanner import DefinitionScanner
+import ast
+import stats
+
+# One shared Type per builtin type, so checked nodes do not each hold a copy
+# and types compare by identity
+builtin_types = {t: ast.Type(t) for t in (*type_to_kind, TYPE_ANY, TYPE_FUNC)}
+NONE = builtin_types[TYPE_NONE]
+ANY = builtin_types[TYPE_ANY]
+FUNC = builtin_types[TYPE_FUNC]
+
+# Name of each type in diagnostics, as written in source
+type_names = {TYPE_ANY: "any", TYPE_FUNC: "function", TYPE_NULL: "null"}
+for word, t in typeword_lookup.items():
+    type_names.setdefault(t, word)
+
+float_types = {TYPE_F32, TYPE_F64}
+
+literal_types = {
+    STRING: builtin_types[TYPE_STRING],
+    CHAR: builtin_types[TYPE_CHAR],
+    TRUE: builtin_types[TYPE_BOOL],
+    FALSE: builtin_types[TYPE_BOOL],
+    NULL: builtin_types[TYPE_NULL],
+}
+
+# Result type of each (operator, operand type) pair. Operands must have the
+# same type, so 1 + 1.0 is an error without a cast. Lookups replace the
+# kind membership tests of each rule.
+binary_rules = {}
+for t in NUMBER_KINDS:
+    for op in (PLUS, MINUS, STAR, SLASH, MODULO):
+        binary_rules[op, t] = t
+    for op in (GREATER, LESS, GREATER_EQUAL, LESS_EQUAL):
+        binary_rules[op, t] = TYPE_BOOL
+for t in type_to_kind:
+    for op in (EQUAL_EQUAL, NOT_EQUAL):
+        binary_rules[op, t] = TYPE_BOOL
+for op in (AND, OR):
+    binary_rules[op, TYPE_BOOL] = TYPE_BOOL
+binary_rules[PLUS, TYPE_STRING] = TYPE_STRING
+
+unary_rules = {(MINUS, t): t for t in NUMBER_KINDS}
+unary_rules[NOT, TYPE_BOOL] = TYPE_BOOL
+
+# Allowed (from, to) casts: between number types, char and byte, and to
+# the same type
+casts = {(a, b) for a in NUMBER_KINDS for b in NUMBER_KINDS}
+casts.update((t, t) for t in type_to_kind)
+casts.update(((TYPE_CHAR, TYPE_BYTE), (TYPE_BYTE, TYPE_CHAR)))
+
+# Checked statement: the types of its nodes in pre-order and its errors as
+# (message, line offset from the statement, start, end)
+class Checked:
+    __slots__ = ("types", "errors")
+
+    def __init__(self, types: list, errors: list):
+        self.types = types
+        self.errors = errors
+
+# Fills in the type of every node, bottom up, and reports type errors. The
+# rules follow docs/lang.md: operands of a binary operator must have the
+# same type, conversions are explicit casts like float(1), and calls,
+# assignments and returns must match the declared types. Nodes that already
+# failed to check get the any type, which matches everything, so one error
+# is not reported again by every node above it.
+#
+# A checker remembers the simple statements it has checked by a digest of
+# their content: the structure, the lexemes and positions of the tokens,
+# the type of the definition of every name used and, for returns, the
+# function returned from. When a tree is checked again, a statement with a
+# remembered digest is skipped, its nodes get the remembered types and its
+# errors are reported again. The statement does not have to be the same
+# node, so parsing the source again reuses the statements that did not
+# change, and editing a token in place checks its statement again.
+# Positions are kept relative to the statement's line, so statements moved
+# by lines added above them are reused too.
+class TypeChecker(ast.Visitor):
+    def __init__(self):
+        self.memo = {}
+        self.errors = []
+
+    # Checks the tree and returns the errors. Names are resolved with uses,
+    # the result of a definition scan, which is run if not given.
+    def check(self, tree: ast.AstNode, uses: dict = None) -> list[NeonSyntaxError]:
+        if uses is None:
+            scanner = DefinitionScanner()
+            scanner.scan(tree)
+            uses = scanner.uses
+
+        with stats.phase("check"):
+            self.uses = uses
+            self.errors = []
+            self.functions = []
+            self.skipped = None  # Statement reused from the last check
+            self.next_memo = {}
+            self.checked = 0     # Statements checked and reused
+            self.reused = 0
+            self.walk(tree.stmts)
+            self.memo = self.next_memo
+            del self.next_memo
+
+        if stats.enabled:
+            stats.count("checker.checked", self.checked)
+            stats.count("checker.reused", self.reused)
+
+        return self.errors
+
+    def error(self, msg: str, at):
+        if type(at) == Token:
+            err = NeonSyntaxError(msg, at.line, at.col, at.col + len(at.lexeme), at.lines)
+        else:
+            err = NeonSyntaxError(msg, at.line, at.start, at.stop, at.lines)
+        self.errors.append(err)
+
+    # ---------------------- STATEMENTS ----------------------
+
+    # Reuses the statement if one with the same content was checked last
+    # time, otherwise starts checking it and returns the nodes to walk
+    def begin(self, node: ast.Stmt, kids: list) -> list | None:
+        self.nodes = stmt_nodes(node)
+        self.digest = self.content_digest(node, self.nodes)
+        entry = self.memo.get(self.digest) or self.next_memo.get(self.digest)
+        if entry is not None:
+            self.next_memo[self.digest] = entry
+            for n, typ in zip(self.nodes, entry.types):
+                n.type = typ
+            for msg, line, start, end in entry.errors:
+                self.errors.append(NeonSyntaxError(msg, node.line + line, start, end, node.lines))
+            self.skipped = node
+            self.reused += 1
+            return None
+
+        self.mark = len(self.errors)
+        return kids
+
+    def end(self, node: ast.Stmt, typ: ast.Type):
+        node.type = typ
+        errors = [(e.msg, e.line - node.line, e.start, e.end) for e in self.errors[self.mark:]]
+        self.next_memo[self.digest] = Checked([n.type for n in self.nodes], errors)
+        self.checked += 1
+
+    def content_digest(self, node: ast.Stmt, nodes: list[ast.ParseNode]) -> bytes:
+        base = node.line
+        parts = [node.signature.digest.hex()]
+        for n in nodes:
+            # Empty nodes are not placed
+            if n.lines is not None:
+                parts.append(f"{n.line - base} {n.start} {n.stop}")
+            for field in ast.token_fields.get(type(n), ()):
+                tok = getattr(n, field)
+                parts.append(f"{tok.lexeme} {tok.line - base} {tok.col}")
+            if type(n) == ast.Variable:
+                parts.append(definition_key(self.uses.get(n)))
+            elif type(n) == ast.Literal:
+                parts.append(literal_type(n).string)
+        if type(node) == ast.Return and self.functions:
+            parts.append(definition_key(self.functions[-1]))
+        return blake2b("\n".join(parts).encode("utf-8"), digest_size=16).digest()
+
+    def visit_ExprStmt(self, node: ast.ExprStmt) -> list:
+        return self.begin(node, [node.expr])
+
+    def leave_ExprStmt(self, node: ast.ExprStmt):
+        if node is not self.skipped:
+            self.end(node, NONE)
+
+    def visit_Declaration(self, node: ast.Declaration) -> list:
+        return self.begin(node, [node.expr])
+
+    def leave_Declaration(self, node: ast.Declaration):
+        if node is self.skipped:
+            return
+        typ = node.expr.type
+        if typ is NONE:
+            self.error(f"'{node.ident.lexeme}' is declared with an expression that has no value", node.ident)
+            typ = ANY
+        self.end(node, typ)
+
+    def visit_Assignment(self, node: ast.Assignment) -> list:
+        return self.begin(node, [node.left, node.expr])
+
+    def leave_Assignment(self, node: ast.Assignment):
+        if node is self.skipped:
+            return
+        if type(node.left) != ast.Variable:
+            self.error("can only assign to a variable", node.left)
+        else:
+            self.match(node.left.type, node.expr.type, node.expr, "in assignment")
+        self.end(node, NONE)
+
+    def visit_Return(self, node: ast.Return) -> list:
+        return self.begin(node, [node.expr])
+
+    def leave_Return(self, node: ast.Return):
+        if node is self.skipped:
+            return
+        at = node if type(node.expr) == ast.Empty else node.expr
+        if not self.functions:
+            self.error("return outside of function", at)
+        else:
+            func = self.functions[-1]
+            self.match(builtin_types.get(func.return_t.type, func.return_t), node.expr.type, at, f"in return of '{func.name}'")
+        self.end(node, NONE)
+
+    def visit_Block(self, node: ast.Block) -> list:
+        node.type = NONE
+        return node.stmts
+
+    def visit_Function(self, node: ast.Function) -> list:
+        node.type = FUNC
+        self.functions.append(node)
+        return node.body.stmts
+
+    def leave_Function(self, node: ast.Function):
+        self.functions.pop()
+
+    # Reports mismatched types, unless either one is any
+    def match(self, expected: ast.Type, got: ast.Type, at, where: str):
+        if expected.type != got.type and expected is not ANY and got is not ANY:
+            self.error(f"mismatched types {name(expected)} and {name(got)} {where}", at)
+
+    # ---------------------- EXPRESSIONS ----------------------
+
+    def leave_Empty(self, node: ast.Empty):
+        node.type = NONE
+
+    def leave_Literal(self, node: ast.Literal):
+        node.type = literal_type(node)
+
+    def leave_Variable(self, node: ast.Variable):
+        typ = definition_type(self.uses.get(node))
+        # Unresolved names are builtins, such as println or len
+        node.type = ANY if typ is None else typ
+
+    def leave_Group(self, node: ast.Group):
+        node.type = node.inner.type
+
+    def leave_Unary(self, node: ast.Unary):
+        t = node.expr.type
+        if t is ANY:
+            node.type = ANY
+        elif (result := unary_rules.get((node.op.type, t.type))) is not None:
+            node.type = builtin_types[result]
+        else:
+            self.error(f"operator '{node.op.lexeme}' is not defined for {name(t)}", node)
+            node.type = ANY
+
+    def leave_Binary(self, node: ast.Binary):
+        left, right = node.left.type, node.right.type
+        if left is ANY or right is ANY:
+            node.type = ANY
+        elif left.type != right.type:
+            self.error(f"mismatched types {name(left)} and {name(right)}", node)
+            node.type = ANY
+        elif (result := binary_rules.get((node.op.type, left.type))) is not None:
+            node.type = builtin_types[result]
+        else:
+            self.error(f"operator '{node.op.lexeme}' is not defined for {name(left)}", node)
+            node.type = ANY
+
+    def leave_Args(self, node: ast.Args):
+        node.type = NONE
+
+    def leave_Call(self, node: ast.Call):
+        args = call_args(node.inner)
+        callee = node.callee
+        definition = self.uses.get(callee) if type(callee) == ast.Variable else None
+
+        if type(definition) == ast.Function:
+            node.type = builtin_types.get(definition.return_t.type, definition.return_t)
+            if len(args) != len(definition.params):
+                self.error(f"'{definition.name}' takes {len(definition.params)} arguments, got {len(args)}", node)
+                return
+            for arg, param in zip(args, definition.params):
+                self.match(builtin_types.get(param.type.type, param.type), arg.type, arg, f"for parameter '{param.name}'")
+
+        elif definition is not None:
+            if callee.type is not ANY:
+                self.error(f"cannot call a value of type {name(callee.type)}", callee)
+            node.type = ANY
+
+        elif type(callee) == ast.Variable and callee.token.lexeme in typeword_lookup:
+            node.type = self.cast(node, args, typeword_lookup[callee.token.lexeme])
+
+        else:
+            node.type = ANY
+
+    # Type of a cast like float(1)
+    def cast(self, node: ast.Call, args: list[ast.Expr], to: str) -> ast.Type:
+        if len(args) != 1:
+            self.error(f"cast to {type_names[to]} takes one value, got {len(args)}", node)
+        elif args[0].type is not ANY and (args[0].type.type, to) not in casts:
+            self.error(f"cannot cast {name(args[0].type)} to {type_names[to]}", node)
+        return builtin_types[to]
+
+# Type of a literal. Folded literals keep the type they were folded to,
+# such as u8, unless their token was edited to the other kind of number.
+def literal_type(node: ast.Literal) -> ast.Type:
+    tok = node.token
+    if tok.type != NUMBER:
+        return literal_types[tok.type]
+    if node.type is not None and (node.type.type in float_types) == tok.isfloat:
+        return node.type
+    return builtin_types[TYPE_F32 if tok.isfloat else TYPE_I32]
+
+# What checking a use of the definition depends on: the type of a
+# variable, or the name, param types and return type of a function
+def definition_key(definition) -> str:
+    if type(definition) == ast.Function:
+        params = ", ".join(p.type.string for p in definition.params)
+        return f"{definition.name}({params}) {definition.return_t.string}"
+    typ = definition_type(definition)
+    return "" if typ is None else typ.string
+
+# Nodes of a simple statement in pre-order
+def stmt_nodes(stmt: ast.Stmt) -> list[ast.ParseNode]:
+    nodes = []
+    stack = [stmt]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(reversed(ast.children(node)))
+    return nodes
+
+# Type of the value a name refers to, None for unresolved names
+def definition_type(definition) -> ast.Type | None:
+    if definition is None:
+        return None
+    if type(definition) == ast.Function:
+        return FUNC
+    if type(definition) == ast.Param:
+        return builtin_types.get(definition.type.type, definition.type)
+    return definition.type
+
+def call_args(inner: ast.Expr) -> list[ast.Expr]:
+    if type(inner) == ast.Args:
+        return inner.args
+    if type(inner) == ast.Empty:
+        return []
+    return [inner]
+
+def name(typ: ast.Type) -> str:
+    return type_names.get(typ.type, typ.string)
+
+# Fills in the types of the tree. Prints the errors and exits if there are
+# any.
+def type_check(tree: ast.AstNode, uses: dict = None):
+    errors = TypeChecker().check(tree, uses)
+    if errors:
+        for err in errors:
+            print(err)
+        exit(1)
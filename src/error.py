@@ -1,30 +1,50 @@
 import util
+from tokens import LineTable
 
 class NeonError(Exception):
     def __init__(self, msg: str):
         self.msg = msg
 
 class NeonSyntaxError(NeonError):
-    def __init__(self, msg: str, line: int, start: int, end: int, string: str, fatal: bool = False):
+    label = "error"
+
+    def __init__(self, msg: str, line: int, start: int, end: int, lines: LineTable, fatal: bool = False):
         self.msg = msg
         self.line = line
         self.start = start
         self.end = end
-        self.string = string
+        self.lines = lines
         self.fatal = fatal
+        self.file = None # Source file, set by the compile driver
+
+    # Line text, only fetched when the error is rendered
+    @property
+    def string(self) -> str:
+        return self.lines.text(self.line)
 
     def __str__(self) -> str:
-        s = f"{util.red('error:')} {self.msg}, line {self.line}\n"
+        where = f"line {self.line}" if self.file is None else f"{self.file} line {self.line}"
+        s = f"{self.color(self.label + ':')} {self.msg}, {where}\n"
         s += f" {self.line} | " + self.string.replace("\n", "").replace("\t", 4*" ") + "\n"
         diff = self.end-self.start if self.end != self.start else 1
-        s += f" {len(str(self.line))*' '} | " + util.red(" "*self.start + "^"*diff) + "\n"
+        s += f" {len(str(self.line))*' '} | " + self.color(" "*self.start + "^"*diff) + "\n"
         return s
 
+    def color(self, text: str) -> str:
+        return util.red(text)
+
+# Diagnostic that does not stop compilation, rendered like a syntax error
+class NeonWarning(NeonSyntaxError):
+    label = "warning"
+
+    def color(self, text: str) -> str:
+        return util.yellow(text)
+
 
 def error_prone(func):
-    def wrap(*args):
+    def wrap(*args, **kwargs):
         try:
-            return func(*args)
+            return func(*args, **kwargs)
         except NeonSyntaxError as err:
             print(err)
             exit(1)
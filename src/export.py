@@ -0,0 +1,129 @@
+import json
+from tokens import *
+import ast
+from arena import node_kinds, builders, node_value
+
+kinds = {k.__name__: k for k in node_kinds}
+encode = json.JSONEncoder(separators=(",", ":")).encode
+
+# Records are single objects on their own line, so the whitespace checks of
+# json.loads are not needed
+decode = json.JSONDecoder().raw_decode
+
+# Writes a tree as json lines, one record per node, for other tools to read
+# instead of the printed tree. Records are written in post-order, so the
+# children of a node are always written before it and are referred to by
+# id, the index of their record in the file. A record holds the node kind,
+# its position, the ids of its child nodes in field order if it has any,
+# and its value if it has one: its token as [type, lexeme, line, col,
+# isfloat], or for a function [name, params, return type, name token].
+# Types are written as [type, user_def] and params as [name, type, name
+# token]. Name tokens are null in trees that have none. The last record
+# is the tree itself, with kind "AstNode" and the ids of the top level
+# statements. Nodes are written as they are visited, so the whole document
+# is never held in memory. Deferred function bodies are parsed.
+class TreeWriter(ast.Visitor):
+    BATCH = 4096
+
+    def __init__(self, out):
+        self.out = out
+        self.lines = []
+        self.count = 0
+        # Child ids of each node being walked, the tree at the bottom
+        self.ids = [[]]
+
+    def write(self, record: dict):
+        self.lines.append(encode(record))
+        if len(self.lines) >= self.BATCH:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.out.write("\n".join(self.lines) + "\n")
+            self.lines.clear()
+
+    def visit_default(self, node: ast.ParseNode) -> list:
+        self.ids.append([])
+        return ast.children(node)
+
+    def leave_default(self, node: ast.ParseNode):
+        record = {
+            "kind": type(node).__name__,
+            "line": node.line,
+            "start": node.start,
+            "stop": node.stop,
+        }
+        kids = self.ids.pop()
+        if kids:
+            record["children"] = kids
+        value = node_value(node)
+        if value is not None:
+            record["value"] = dump_value(value)
+        if node.type is not None:
+            record["type"] = dump_type(node.type)
+
+        self.write(record)
+        self.ids[-1].append(self.count)
+        self.count += 1
+
+def write_tree(tree: ast.AstNode, out):
+    writer = TreeWriter(out)
+    writer.walk(tree.stmts)
+    writer.write({"kind": "AstNode", "children": writer.ids.pop()})
+    writer.flush()
+
+def dump_value(value) -> list:
+    if type(value) == tuple:
+        name, params, return_t, ident = value
+        params = [[p.name, dump_type(p.type), dump_token(p.token)] for p in params]
+        return [name, params, dump_type(return_t), dump_token(ident)]
+    return dump_token(value)
+
+def dump_token(tok: Token | None) -> list | None:
+    return None if tok is None else [tok.type, tok.lexeme, tok.line, tok.col, tok.isfloat]
+
+def dump_type(typ: ast.Type | None) -> list | None:
+    return None if typ is None else [typ.type, typ.user_def]
+
+# Reads a tree written by write_tree from a text stream. Tokens and nodes
+# refer to the line table of src if given, otherwise they have no line
+# text. Raises ValueError if the tree record is missing.
+def load_tree(f, src: str = None) -> ast.AstNode:
+    lines = LineTable(src) if src is not None else None
+    nodes = []
+    for record in f:
+        r = decode(record)[0]
+        kids = [nodes[i] for i in r.get("children", ())]
+        if r["kind"] == "AstNode":
+            tree = ast.AstNode()
+            tree.stmts = kids
+            return tree
+
+        kind = kinds[r["kind"]]
+        node = builders[kind](kids, load_value(kind, r.get("value"), lines))
+        node.line = r["line"]
+        node.start = r["start"]
+        node.stop = r["stop"]
+        node.lines = lines
+        node.type = load_type(r.get("type"))
+        nodes.append(node)
+
+    raise ValueError("ast file ends before the tree record")
+
+def load_value(kind: type, value: list | None, lines: LineTable):
+    if value is None:
+        return None
+    if kind == ast.Function:
+        name, params, return_t, ident = value
+        params = [ast.Param(n, load_type(t), load_token(tok, lines)) for n, t, tok in params]
+        return name, params, load_type(return_t), load_token(ident, lines)
+    return load_token(value, lines)
+
+def load_token(tok: list | None, lines: LineTable) -> Token | None:
+    if tok is None:
+        return None
+    typ, lexeme, line, col, isfloat = tok
+    return Token(typ, lexeme, line, col, lines, token_kinds.get(typ, KIND_NONE), isfloat)
+
+def load_type(typ: list | None) -> ast.Type | None:
+    return None if typ is None else ast.Type(*typ)
@@ -0,0 +1,258 @@
+import math
+import struct
+import operator
+from decimal import Decimal
+from tokens import *
+from error import *
+import checker
+import ast
+import stats
+
+# Value range of each integer type
+int_ranges = {
+    TYPE_I8: (-1 << 7, (1 << 7) - 1),
+    TYPE_I16: (-1 << 15, (1 << 15) - 1),
+    TYPE_I32: (-1 << 31, (1 << 31) - 1),
+    TYPE_I64: (-1 << 63, (1 << 63) - 1),
+    TYPE_U8: (0, (1 << 8) - 1),
+    TYPE_U16: (0, (1 << 16) - 1),
+    TYPE_U32: (0, (1 << 32) - 1),
+    TYPE_U64: (0, (1 << 64) - 1),
+    TYPE_BYTE: (0, (1 << 8) - 1),
+}
+
+float_types = {TYPE_F32, TYPE_F64}
+
+# Integer division and remainder truncate toward zero, like the generated C
+def int_div(a: int, b: int) -> int:
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def int_mod(a: int, b: int) -> int:
+    return a - b * int_div(a, b)
+
+int_ops = {
+    PLUS: operator.add,
+    MINUS: operator.sub,
+    STAR: operator.mul,
+    SLASH: int_div,
+    MODULO: int_mod,
+}
+
+# Float remainder is not folded, C has no % for floats
+float_ops = {
+    PLUS: operator.add,
+    MINUS: operator.sub,
+    STAR: operator.mul,
+    SLASH: operator.truediv,
+}
+
+compare_ops = {
+    EQUAL_EQUAL: operator.eq,
+    NOT_EQUAL: operator.ne,
+    GREATER: operator.gt,
+    LESS: operator.lt,
+    GREATER_EQUAL: operator.ge,
+    LESS_EQUAL: operator.le,
+}
+
+bool_ops = {
+    AND: lambda a, b: a and b,
+    OR: lambda a, b: a or b,
+    EQUAL_EQUAL: operator.eq,
+    NOT_EQUAL: operator.ne,
+}
+
+string_ops = {
+    PLUS: operator.add,
+    EQUAL_EQUAL: operator.eq,
+    NOT_EQUAL: operator.ne,
+}
+
+# Folds Binary, Unary and Group nodes over number, string and bool literals,
+# and casts of number literals like u8(1), into a single Literal. The tree
+# must be type checked first: values are computed in the type of the
+# operands, integers are checked against the range of their type and f32
+# results are rounded to single precision after every operation. Overflow
+# and integer division by zero are reported and leave the node as it was,
+# float division by zero is not folded. Nodes are folded bottom up, so
+# nested constants fold completely. Parents of replaced nodes get their
+# signature digest dropped, so a later type check sees the changed
+# statements.
+class ConstantFolder(ast.Visitor):
+    def __init__(self):
+        self.errors = []
+        self.folded = 0
+        self.folds = {}    # Node to the literal it folds to
+        self.changed = set()
+
+    def fold(self, tree: ast.AstNode) -> list[NeonSyntaxError]:
+        with stats.phase("fold"):
+            self.walk(tree.stmts)
+            self.folds.clear()
+            self.changed.clear()
+        if stats.enabled:
+            stats.count("folder.folded", self.folded)
+        return self.errors
+
+    # Children are left before their parent, so the parent swaps in their
+    # literals and then tries to fold itself
+    def leave_default(self, node: ast.ParseNode):
+        changed = False
+        for field, child in list(ast.child_items(node)):
+            lit = self.folds.pop(child, None)
+            if lit is not None:
+                ast.replace(node, field, child, lit)
+                changed = True
+            elif child in self.changed:
+                self.changed.discard(child)
+                changed = True
+
+        if changed:
+            node.signature.changed()
+            self.changed.add(node)
+
+        lit = self.constant(node)
+        if lit is not None:
+            self.folds[node] = lit
+            self.folded += 1
+
+    def error(self, msg: str, node: ast.ParseNode):
+        self.errors.append(NeonSyntaxError(msg, node.line, node.start, node.stop, node.lines))
+
+    # Literal the node folds to, or None
+    def constant(self, node: ast.ParseNode) -> ast.Literal | None:
+        t = type(node)
+        if t == ast.Group:
+            return node.inner if type(node.inner) == ast.Literal else None
+        if node.type is None or node.type is checker.ANY:
+            return None
+        if t == ast.Binary:
+            return self.binary(node)
+        if t == ast.Unary:
+            return self.unary(node)
+        if t == ast.Call:
+            return self.cast(node)
+        return None
+
+    def binary(self, node: ast.Binary) -> ast.Literal | None:
+        left, right = node.left, node.right
+        if type(left) != ast.Literal or type(right) != ast.Literal:
+            return None
+
+        op, t = node.op.type, left.type.type
+        a, b = value(left), value(right)
+        if op in compare_ops and (t in int_ranges or t in float_types):
+            return self.literal(node, compare_ops[op](a, b))
+        if t == TYPE_BOOL and op in bool_ops:
+            return self.literal(node, bool_ops[op](a, b))
+        if t == TYPE_STRING and op in string_ops:
+            return self.literal(node, string_ops[op](a, b))
+
+        ops = int_ops if t in int_ranges else float_ops if t in float_types else {}
+        if op not in ops:
+            return None
+        if op in (SLASH, MODULO) and b == 0:
+            # Float division by zero gives inf or nan at run time, like in
+            # C, which has no literal to fold to
+            if t in int_ranges:
+                self.error("division by zero in constant expression", node)
+            return None
+        return self.literal(node, ops[op](a, b))
+
+    def unary(self, node: ast.Unary) -> ast.Literal | None:
+        if type(node.expr) != ast.Literal:
+            return None
+        a = value(node.expr)
+        if node.op.type == NOT:
+            return self.literal(node, not a)
+        return self.literal(node, -a)
+
+    # Cast of a number literal, such as float(1) or u8(200)
+    def cast(self, node: ast.Call) -> ast.Literal | None:
+        callee, inner = node.callee, node.inner
+        if type(callee) != ast.Variable or callee.type is not checker.ANY or callee.token.lexeme not in typeword_lookup:
+            return None
+        if type(inner) != ast.Literal or (inner.type.type not in int_ranges and inner.type.type not in float_types):
+            return None
+
+        a = value(inner)
+        if node.type.type in int_ranges and type(a) == float:
+            if not math.isfinite(a):
+                self.error(f"constant overflows {checker.name(node.type)}", node)
+                return None
+            a = int(a) # Truncates like a C cast
+        return self.literal(node, a)
+
+    # Literal of the value in the node's type, or None if it does not fit
+    def literal(self, node: ast.Expr, v) -> ast.Literal | None:
+        t = node.type.type
+        if t == TYPE_BOOL:
+            tok = (TRUE, "true") if v else (FALSE, "false")
+        elif t == TYPE_STRING:
+            tok = (STRING, v)
+        elif t in int_ranges:
+            lo, hi = int_ranges[t]
+            if not lo <= v <= hi:
+                self.error(f"constant overflows {checker.name(node.type)}", node)
+                return None
+            tok = (NUMBER, str(v))
+        elif t in float_types:
+            v = round_float(float(v), t)
+            if not math.isfinite(v):
+                self.error(f"constant overflows {checker.name(node.type)}", node)
+                return None
+            tok = (NUMBER, float_lexeme(v, t))
+        else:
+            return None
+
+        typ, lexeme = tok
+        lit = ast.Literal(Token(typ, lexeme, node.line, node.start, node.lines,
+            token_kinds.get(typ, KIND_NONE), t in float_types))
+        lit.type = node.type
+        lit.line = node.line
+        lit.start = node.start
+        lit.stop = node.stop
+        lit.lines = node.lines
+        return lit
+
+# Value of a literal in its checked type
+def value(lit: ast.Literal):
+    t = lit.type.type
+    lexeme = lit.token.lexeme
+    if t in int_ranges:
+        return int(lexeme)
+    if t in float_types:
+        return round_float(float(lexeme), t)
+    if t == TYPE_BOOL:
+        return lexeme == "true"
+    return lexeme
+
+def round_float(v: float, t: str) -> float:
+    if t != TYPE_F32 or not math.isfinite(v):
+        return v
+    try:
+        return struct.unpack("f", struct.pack("f", v))[0]
+    except OverflowError:
+        return math.inf if v > 0 else -math.inf
+
+# Shortest decimal that reads back as the same value in its type, without
+# an exponent since the lexer does not read one
+def float_lexeme(v: float, t: str) -> str:
+    s = repr(v)
+    if t == TYPE_F32:
+        for digits in range(1, 10):
+            s = f"{v:.{digits}g}"
+            if round_float(float(s), t) == v:
+                break
+    s = format(Decimal(s), "f")
+    return s if "." in s else s + ".0"
+
+# Folds the constants of a type checked tree. Prints the errors and exits
+# if there are any.
+def fold_constants(tree: ast.AstNode):
+    errors = ConstantFolder().fold(tree)
+    if errors:
+        for err in errors:
+            print(err)
+        exit(1)
@@ -0,0 +1,61 @@
+import ast
+
+# Expression nodes that can be shared. Variables and calls are left alone
+# since two uses of the same name are not the same node to later passes.
+shareable = (ast.Empty, ast.Literal, ast.Group, ast.Binary, ast.Unary, ast.Args)
+
+# Hash-conses constant expressions so identical subtrees share one node.
+# Nodes are keyed on their signature digest, their own token text and the
+# identity of their (already shared) children. The shared node keeps the
+# position of its first occurrence. One Interner can be used for several
+# trees to share nodes between them.
+class Interner:
+    def __init__(self):
+        self.table = {}
+        self.nodes = 0
+        self.dropped = 0
+        self.saved = 0
+
+    # Shares identical constant subtrees in the tree in place. Function
+    # bodies that have not been parsed are skipped.
+    def intern_tree(self, tree: ast.AstNode) -> ast.AstNode:
+        # Reversed pre-order visits children before their parents
+        order = list(ast.walk(tree))
+
+        canon = {}
+        for node in reversed(order):
+            for field, child in list(ast.child_items(node)):
+                shared = canon.get(id(child))
+                if shared is not None and shared is not child:
+                    ast.replace(node, field, child, shared)
+
+            if self.constant(node, canon):
+                canon[id(node)] = self.intern(node)
+
+        tree.stmts = [canon.get(id(s), s) for s in tree.stmts]
+        return tree
+
+    # Returns the shared node equal to a node whose children are shared
+    def intern(self, node: ast.ParseNode) -> ast.ParseNode:
+        key = (type(node), node.signature.digest, own_text(node), tuple(id(c) for c in ast.children(node)))
+        self.nodes += 1
+        shared = self.table.setdefault(key, node)
+        if shared is not node:
+            self.dropped += 1
+            self.saved += ast.node_size(node)
+
+        return shared
+
+    # If a node is shareable and all its children are already shared
+    def constant(self, node: ast.ParseNode, canon: dict) -> bool:
+        if type(node) not in shareable:
+            return False
+        return all(canon.get(id(c)) is c for c in ast.children(node))
+
+    def report(self) -> str:
+        return f"interned {self.nodes} nodes, {self.dropped} shared, {self.saved} bytes saved"
+
+# Text of the tokens a node holds itself, with their types
+def own_text(node: ast.ParseNode) -> tuple:
+    toks = (getattr(node, name) for name in ast.token_fields.get(type(node), ()))
+    return tuple((t.type, t.lexeme) for t in toks)
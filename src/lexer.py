@@ -1,5 +1,12 @@
+import re
+import os
+import sys
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left, bisect_right
 from tokens import *
 from error import *
+import stats
 
 def print_tokens(tokens: list):
     for t in tokens:
@@ -8,22 +15,186 @@ def print_tokens(tokens: list):
             print()
     print()
 
+# Returns the token list for the source string. The table driven engine is
+# used by default, the legacy engine is kept for comparison in tests. With
+# jobs > 1 large sources are lexed in parallel. The vector engine is faster
+# for large ascii sources but needs numpy. Both lex into a TokenBuffer first,
+# the default path creates the tokens directly. Creating the tokens takes
+# most of the time, so the vector engine only pays off with get_token_buffer.
 @error_prone
-def get_tokens(src: str) -> list[Token]:
+def get_tokens(src: str, legacy: bool = False, jobs: int = 1, vector: bool = False) -> list[Token]:
+    if jobs > 1 or vector:
+        return lex_buffer(src, jobs, vector).tokens()
+
+    with stats.phase("lex"):
+        tokens = legacy_tokens(src) if legacy else table_tokens(src)
+    if stats.enabled:
+        stats.count("lexer.tokens", len(tokens))
+    return tokens
+
+# Returns the tokens of the source as a compact TokenBuffer. Token objects
+# are only created when the buffer is indexed.
+@error_prone
+def get_token_buffer(src: str, jobs: int = 1, vector: bool = False) -> TokenBuffer:
+    return lex_buffer(src, jobs, vector)
+
+# Lexes the source into a TokenBuffer with the chosen engine. Raises the
+# first syntax error instead of exiting.
+def lex_buffer(src: str, jobs: int = 1, vector: bool = False) -> TokenBuffer:
+    with stats.phase("lex"):
+        if vector:
+            buf = vector_buffer(src)
+        elif jobs > 1:
+            buf = parallel_buffer(src, jobs)
+        else:
+            buf = table_buffer(src)
+
+    if stats.enabled:
+        stats.count("lexer.tokens", len(buf))
+    return buf
+
+# Smallest chunk lexed by a worker in parallel_buffer
+PARALLEL_CHUNK = 1 << 18
+
+# Lexes the source in newline aligned chunks on a process pool. Lexer state
+# resets at every newline, so each chunk can be lexed on its own from its
+# first line number. Workers get the source once and return the token
+# columns of their chunk, which are joined in order. Gives the same buffer,
+# and the same first error, as table_buffer.
+def parallel_buffer(src: str, jobs: int = None) -> TokenBuffer:
+    jobs = jobs or os.cpu_count() or 1
+    size = max(PARALLEL_CHUNK, len(src) // (jobs * 4) + 1)
+    if jobs == 1 or len(src) <= size:
+        return table_buffer(src)
+
+    # Chunks as (start, end, first line)
+    chunks = []
+    pos, line = 0, 1
+    while pos < len(src):
+        end = src.find("\n", pos + size) + 1 or len(src)
+        chunks.append((pos, end, line))
+        line += src.count("\n", pos, end)
+        pos = end
+
+    buf = TokenBuffer(src, LineTable(src))
+    with ProcessPoolExecutor(jobs, initializer=set_chunk_source, initargs=(src,)) as pool:
+        for columns in pool.map(lex_chunk, chunks):
+            if type(columns[0]) == str:
+                # First error in source order, same as the sequential lexer
+                raise NeonSyntaxError(*columns[1:], buf.lines)
+            for column, part in zip(buffer_columns(buf), columns):
+                column.extend(part)
+
+    return buf
+
+def buffer_columns(buf: TokenBuffer) -> tuple:
+    return (buf.types, buf.starts, buf.lengths, buf.line_nos, buf.cols, buf.flags)
+
+# Source of the parallel lexer workers, set once per worker process
+chunk_source = ""
+
+def set_chunk_source(src: str):
+    global chunk_source
+    chunk_source = src
+
+# Lexes one chunk of chunk_source in a worker. Returns the token columns,
+# or the error fields since the error's line table is not sent back.
+def lex_chunk(chunk: tuple[int, int, int]) -> tuple:
+    start, end, line = chunk
+    buf = TokenBuffer(chunk_source, LineTable(""))
+    try:
+        scan(buf, start, end, line)
+    except NeonSyntaxError as err:
+        return ("error", err.msg, err.line, err.start, err.end)
+    return buffer_columns(buf)
+
+# Size of the source chunks lexed at a time by iter_tokens
+STREAM_CHUNK = 1 << 16
+
+# Memory maps the file for iter_tokens. Empty files can not be mapped and
+# are returned as empty bytes.
+def map_file(filename: str) -> mmap.mmap | bytes:
+    with open(filename, "rb") as f:
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b""
+
+# Yields the tokens of the source one at a time. The source is a string or
+# utf-8 bytes, like a memory mapped file. It is lexed in newline aligned
+# chunks, so only the current chunk is decoded and buffered. Tokens keep a
+# reference to the line table of their own chunk.
+def iter_tokens(source: str | bytes | mmap.mmap):
+    newline = "\n" if type(source) == str else b"\n"
+    size = len(source)
+    pos = 0
+    line = 1
+
+    while pos < size:
+        end = size
+        if pos + STREAM_CHUNK < size:
+            end = source.rfind(newline, pos, pos + STREAM_CHUNK) + 1
+            if end == 0:
+                end = source.find(newline, pos + STREAM_CHUNK) + 1 or size
+
+        chunk = source[pos:end]
+        if type(chunk) != str:
+            chunk = chunk.decode("utf-8")
+
+        lines = LineTable(chunk, line)
+        buf = TokenBuffer(chunk, lines)
+        scan(buf, 0, len(chunk), line)
+        yield from buf
+
+        line += len(lines) - 1
+        pos = end
+
+# Applies an edit to a lexed source: removed characters at offset are
+# replaced by the inserted text. Lexer state resets at every newline, so
+# only the lines touched by the edit are lexed again. Later tokens keep
+# their columns and have their line numbers shifted. The token list and its
+# line table are updated in place, on error both are left unchanged. The
+# line table replaces only the touched lines, so an edit that keeps the
+# number of lines costs the same however long the source is.
+def relex(tokens: list[Token], lines: LineTable, offset: int, removed: int, inserted: str) -> list[Token]:
+    if offset < 0 or offset + removed > lines.size:
+        raise IndexError("edit out of range")
+
+    # Index of the first and last line touched by the edit
+    first = lines.index(offset)
+    last = lines.index(offset + removed)
+    start = lines.start(first)
+
+    # Lex the new text of the touched lines before changing anything
+    line = first + lines.first
+    old = lines.span(first, last)
+    text = old[:offset-start] + inserted + old[offset+removed-start:]
+    buf = TokenBuffer(text, LineTable(text, line))
+    scan(buf, 0, len(text), line)
+    shift = text.count("\n") - old.count("\n")
+    lines.replace(first, last, text)
+
+    # Replace tokens on the touched lines and shift the later ones
+    lo = bisect_left(tokens, line, key=lambda t: t.line)
+    hi = bisect_right(tokens, last + lines.first, key=lambda t: t.line)
+    if shift != 0:
+        for i in range(hi, len(tokens)):
+            tokens[i].line += shift
+
+    buf.lines = lines
+    tokens[lo:hi] = buf.tokens()
+    return tokens
+
+# Original character by character lexer
+def legacy_tokens(src: str) -> list[Token]:
     tokens = []
     start_idx = 0
     idx = 0
     start_col = 0
     col = 0
     line = 1
-    line_string = ""
+    lines = LineTable(src)
 
-    # Read first line
-    for c in src[idx:]:
-        if c == '\n':
-            break
-        line_string += c
-    
     while idx < len(src):
 
         # Comment
@@ -35,14 +206,7 @@ def get_tokens(src: str) -> list[Token]:
         # White space
         if src[idx] in whitespace_lookup:
             if src[idx] == '\n':
-                tokens.append(Token(NEWLINE, "NEWLINE", line, col, line_string, KIND_NONE))
-
-                # Read new line
-                line_string = ""
-                for c in src[idx+1:]:
-                    if c == '\n':
-                        break
-                    line_string += c
+                tokens.append(Token(NEWLINE, "NEWLINE", line, col, lines, KIND_NONE))
                 line += 1
                 col = -1
 
@@ -58,11 +222,11 @@ def get_tokens(src: str) -> list[Token]:
             
             word = src[start_idx:idx]
             if word in keyword_lookup:
-                tokens.append(Token(keyword_lookup[word], word, line, col, line_string, KIND_NONE))
+                tokens.append(Token(keyword_lookup[word], word, line, col, lines, KIND_NONE))
             elif word in typeword_lookup:
-                tokens.append(Token(IDENTIFIER, word, line, col, line_string, KIND_NONE))
+                tokens.append(Token(IDENTIFIER, sys.intern(word), line, col, lines, KIND_NONE))
             else:
-                tokens.append(Token(IDENTIFIER, word, line, col, line_string, KIND_NONE))
+                tokens.append(Token(IDENTIFIER, sys.intern(word), line, col, lines, KIND_NONE))
             
             col += len(word)
             continue
@@ -79,17 +243,17 @@ def get_tokens(src: str) -> list[Token]:
                 col += 1
             
             if dots > 1:
-                raise NeonSyntaxError("invalid number", line, start_col, col, line_string)
+                raise NeonSyntaxError("invalid number", line, start_col, col, lines)
 
             number = src[start_idx:idx]
-            tokens.append(Token(NUMBER, number, line, start_col, line_string, KIND_NUMBER, isfloat=dots>0))
+            tokens.append(Token(NUMBER, number, line, start_col, lines, KIND_NUMBER, isfloat=dots>0))
             continue
 
         # Double symbol
         if idx + 1 < len(src):
             symbol = src[idx:idx+2]
             if symbol in double_symbol_lookup:
-                tokens.append(Token(double_symbol_lookup[symbol], symbol, line, col, line_string, KIND_NONE))
+                tokens.append(Token(double_symbol_lookup[symbol], symbol, line, col, lines, KIND_NONE))
                 idx += 2
                 col += 2
                 continue
@@ -97,7 +261,7 @@ def get_tokens(src: str) -> list[Token]:
         # Single symbol
         if src[idx] in symbol_lookup:
             symbol = src[idx]
-            tokens.append(Token(symbol_lookup[symbol], symbol, line, col, line_string, KIND_NONE))
+            tokens.append(Token(symbol_lookup[symbol], symbol, line, col, lines, KIND_NONE))
             idx += 1
             col += 1
             continue
@@ -110,20 +274,455 @@ def get_tokens(src: str) -> list[Token]:
             col += 1
             while idx < len(src) and src[idx] != '"':
                 if src[idx] == '\n':
-                    raise NeonSyntaxError("unterminated string", line, start_col, col, line_string)
+                    raise NeonSyntaxError("unterminated string", line, start_col, col, lines)
 
                 string += src[idx]
                 idx += 1
                 col += 1
             
             if idx >= len(src):
-                raise NeonSyntaxError("unterminated string", line, start_col, col, line_string)
+                raise NeonSyntaxError("unterminated string", line, start_col, col, lines)
 
-            tokens.append(Token(STRING, string, line, start_col, line_string, KIND_STRING))
+            tokens.append(Token(STRING, string, line, start_col, lines, KIND_STRING))
             idx += 1
             col += 1
             continue
 
-        raise NeonSyntaxError("unknown token", line, col, col, line_string)
+        raise NeonSyntaxError("unknown token", line, col, col, lines)
+
+    return tokens
+
+
+# -------------------- TABLE ENGINE --------------------
+
+# The table engine matches a whole token with a single compiled pattern and
+# dispatches on the group that matched. Groups are ordered so the result is
+# the same token stream as the legacy lexer's branches produce. Every group
+# starts with an ascii character, anything else (unicode words or numbers,
+# unterminated strings and unknown characters) goes to slow_token.
+
+def alternation(symbols) -> str:
+    return "|".join(re.escape(s) for s in sorted(symbols, key=len, reverse=True))
+
+# Pattern group numbers
+M_WORD, M_SYMBOL, M_NEWLINE, M_NUMBER, M_STRING, M_COMMENT, M_SLASH, M_OTHER = range(1, 9)
+
+# Leading spaces and tabs are folded into the next match so whitespace does
+# not cost an iteration of its own. Words and symbols are the most common
+# tokens and come first. Symbols are tried longest first, so double symbols
+# win over single ones like in the legacy lexer. The comment start and a
+# lone slash come last since they share their first character. Any other
+# character is matched by the last group so the search never skips over
+# input.
+master_pattern = re.compile(
+    r"[ \t]*(?:"
+    r"([A-Za-z]\w*)"
+    f"|({alternation((set(double_symbol_lookup) | set(symbol_lookup)) - {'//', '/'})})"
+    r"|(\n)"
+    r"|([0-9][0-9.]*)"
+    r'|("[^"\n]*")'
+    r"|(//[^\n]*)"
+    r"|(/)"
+    r"|([^ \t]))"
+)
+
+word_pattern = re.compile(r"\w+")
+
+# Returns the end of the number starting at idx. Only needed when the number
+# contains non-ascii numeric characters, which the pattern does not match.
+def number_end(src: str, idx: int, end: int) -> int:
+    while idx < end and (src[idx].isnumeric() or src[idx] == '.'):
+        idx += 1
+    return idx
+
+# Returns the flags for a number token, raises error if invalid
+def number_flags(number: str, line: int, col: int, lines: LineTable) -> int:
+    dots = number.count(".")
+    if dots > 1:
+        raise NeonSyntaxError("invalid number", line, col, col+len(number), lines)
+    return FLAG_FLOAT if dots > 0 else 0
+
+# Handles a single token the master pattern could not match. Returns the
+# index after the token or raises the same error as the legacy lexer.
+def slow_token(buf: TokenBuffer, idx: int, end: int, line: int, col: int) -> int:
+    src = buf.src
+    c = src[idx]
+    if c.isalpha():
+        stop = word_pattern.match(src, idx, end).end()
+        typ = keyword_lookup.get(src[idx:stop], IDENTIFIER)
+        buf.append(typ, idx, stop-idx, line, col)
+        return stop
+
+    if c.isnumeric():
+        stop = number_end(src, idx, end)
+        flags = number_flags(src[idx:stop], line, col, buf.lines)
+        buf.append(NUMBER, idx, stop-idx, line, col, flags)
+        return stop
+
+    if c == '"':
+        stop = src.find("\n", idx, end)
+        if stop == -1: stop = end
+        raise NeonSyntaxError("unterminated string", line, col, col+stop-idx, buf.lines)
+
+    raise NeonSyntaxError("unknown token", line, col, col, buf.lines)
+
+# Type and kind of the words and symbols the pattern matches, so a token is
+# created with a single lookup
+word_tokens = {word: (typ, token_kinds.get(typ, KIND_NONE)) for word, typ in keyword_lookup.items()}
+symbol_types = symbol_lookup | double_symbol_lookup
+symbol_tokens = {sym: (typ, token_kinds.get(typ, KIND_NONE)) for sym, typ in symbol_types.items()}
+
+# Table driven lexer. Produces the same tokens and errors as legacy_tokens.
+# Same loop as scan, but creates Token objects as it goes, which is faster
+# than filling a TokenBuffer and converting it. Unicode numbers and the
+# slow_token cases go through a small buffer.
+def table_tokens(src: str) -> list[Token]:
+    lines = LineTable(src)
+    tokens = []
+    push = tokens.append
+    intern = sys.intern
+    finditer = master_pattern.finditer
+    ident_kind = token_kinds.get(IDENTIFIER, KIND_NONE)
+    idx, end, line, line_start = 0, len(src), 1, 0
+    comment_col = -1
+
+    while True:
+        for m in finditer(src, idx, end):
+            group = m.lastindex
+            start, idx = m.span(group)
+            col = start - line_start
+
+            if group == M_WORD:
+                word = m.group(group)
+                if (known := word_tokens.get(word)) is None:
+                    push(Token(IDENTIFIER, intern(word), line, col, lines, ident_kind))
+                else:
+                    push(Token(known[0], word, line, col, lines, known[1]))
+
+            elif group == M_SYMBOL or group == M_SLASH:
+                sym = m.group(group)
+                typ, kind = symbol_tokens[sym]
+                push(Token(typ, sym, line, col, lines, kind))
+
+            elif group == M_NEWLINE:
+                if comment_col != -1:
+                    col = comment_col
+                    comment_col = -1
+                push(Token(NEWLINE, "NEWLINE", line, col, lines, KIND_NONE))
+                line += 1
+                line_start = idx
+
+            elif group == M_NUMBER:
+                if idx < end and src[idx] > "\x7f":
+                    idx = number_end(src, idx, end)
+                number = src[start:idx]
+                flags = number_flags(number, line, col, lines)
+                push(Token(NUMBER, number, line, col, lines, KIND_NUMBER, flags != 0))
+                if idx != m.end():
+                    break
+
+            elif group == M_STRING:
+                push(Token(STRING, src[start+1:idx-1], line, col, lines, KIND_STRING))
+
+            elif group == M_COMMENT:
+                comment_col = col
+
+            else:
+                buf = TokenBuffer(src, lines)
+                idx = slow_token(buf, start, end, line, col)
+                tokens.extend(buf.tokens())
+                break
+        else:
+            break
+
+    return tokens
+
+# Lexes the source into a new token buffer
+def table_buffer(src: str) -> TokenBuffer:
+    buf = TokenBuffer(src, LineTable(src))
+    scan(buf, 0, len(src), 1)
+    return buf
+
+# Lexes buf.src from idx to end into buf. idx must be at the start of the
+# given line and end at a line end, lexer state does not carry over lines.
+def scan(buf: TokenBuffer, idx: int, end: int, line: int):
+    src = buf.src
+    lines = buf.lines
+    append = buf.append
+    finditer = master_pattern.finditer
+    line_start = idx
+    # The legacy lexer does not advance the column while skipping a comment,
+    # so a newline after a comment is reported at the comment start.
+    comment_col = -1
+
+    while True:
+        for m in finditer(src, idx, end):
+            group = m.lastindex
+            start, idx = m.span(group)
+            col = start - line_start
+
+            if group == M_WORD:
+                append(keyword_lookup.get(m.group(group), IDENTIFIER), start, idx-start, line, col)
+
+            elif group == M_SYMBOL or group == M_SLASH:
+                append(symbol_types[m.group(group)], start, idx-start, line, col)
+
+            elif group == M_NEWLINE:
+                if comment_col != -1:
+                    col = comment_col
+                    comment_col = -1
+                append(NEWLINE, start, 1, line, col)
+                line += 1
+                line_start = idx
+
+            elif group == M_NUMBER:
+                # Unicode numerics are not matched by the pattern
+                if idx < end and src[idx] > "\x7f":
+                    idx = number_end(src, idx, end)
+                    append(NUMBER, start, idx-start, line, col, number_flags(src[start:idx], line, col, lines))
+                    break
+                append(NUMBER, start, idx-start, line, col, number_flags(m.group(group), line, col, lines))
+
+            elif group == M_STRING:
+                append(STRING, start, idx-start, line, col)
+
+            elif group == M_COMMENT:
+                comment_col = col
+
+            else:
+                # Fall back to slow_token, then restart the search
+                idx = slow_token(buf, start, end, line, col)
+                break
+        else:
+            break
+
+
+# -------------------- VECTOR ENGINE --------------------
+
+# Optional engine for bulk lexing of ascii sources with numpy. Every byte is
+# classified at once with lookup arrays built from the token tables, and
+# token starts, ends, lines and columns are found with array operations.
+# Lines the array rules do not cover (errors and unterminated strings) are
+# lexed with scan, so the result is the same as table_buffer. Sources that
+# are mostly such lines go to table_buffer directly.
+
+np = None
+
+# Imports numpy on first use. numpy needs the standard library ast module,
+# which ast.py in this directory shadows, so the import runs with the
+# standard module in place and the local one is restored after.
+def load_numpy():
+    global np
+    here = os.path.dirname(os.path.abspath(__file__))
+    local = sys.modules.pop("ast", None)
+    path = sys.path[:]
+    sys.path[:] = [p for p in path if os.path.abspath(p or ".") != here]
+    try:
+        import numpy
+        np = numpy
+    except ImportError:
+        raise ImportError("the vector lexer needs numpy") from None
+    finally:
+        sys.path[:] = path
+        sys.modules.pop("ast", None)
+        if local is not None:
+            sys.modules["ast"] = local
+
+# Byte classes
+C_OTHER, C_ALPHA, C_DIGIT, C_UNDER, C_DOT, C_SPACE, C_NEWLINE, C_QUOTE, C_SLASH, C_SYMBOL = range(10)
+
+def byte_tables() -> tuple:
+    classes = np.full(256, C_OTHER, np.uint8)
+    for c in range(256):
+        ch = chr(c)
+        if ch.isascii() and ch.isalpha():
+            classes[c] = C_ALPHA
+        elif ch.isascii() and ch.isdigit():
+            classes[c] = C_DIGIT
+
+    symbol_chars = set("".join(symbol_lookup) + "".join(double_symbol_lookup))
+    for ch in symbol_chars:
+        classes[ord(ch)] = C_SYMBOL
+    for ch, cls in (("_", C_UNDER), (".", C_DOT), (" ", C_SPACE), ("\t", C_SPACE),
+                    ("\n", C_NEWLINE), ('"', C_QUOTE), ("/", C_SLASH)):
+        classes[ord(ch)] = cls
+
+    # Token type of single and double symbols, 0 if not a symbol
+    singles = np.zeros(256, np.uint8)
+    for s, typ in symbol_lookup.items():
+        singles[ord(s)] = typ
+    doubles = np.zeros(1 << 16, np.uint8)
+    for s, typ in double_symbol_lookup.items():
+        if s != "//":
+            doubles[ord(s[0]) << 8 | ord(s[1])] = typ
+
+    # Keywords packed like in vector_buffer, sorted, and their token types
+    packed = sorted((sum(ord(c) << 8*i for i, c in enumerate(k)), typ) for k, typ in keyword_lookup.items())
+    keywords = np.array([p for p, _ in packed], np.uint64)
+    keyword_types = np.array([typ for _, typ in packed], np.uint8)
+
+    return classes, singles, doubles, keywords, keyword_types
+
+byte_classes = None
+
+# Same buffer and errors as table_buffer, non-ascii sources are passed on
+# to it. Needs numpy.
+def vector_buffer(src: str) -> TokenBuffer:
+    global byte_classes
+    if np is None:
+        load_numpy()
+    if not src.isascii() or len(src) == 0:
+        return table_buffer(src)
+    if byte_classes is None:
+        byte_classes = byte_tables()
+
+    classes, singles, doubles, keywords, keyword_types = byte_classes
+    data = np.frombuffer(src.encode("ascii"), np.uint8)
+    n = len(data)
+    cls = classes[data]
+    idx = np.arange(n, dtype=np.int32)
+
+    # Line of each byte and the start of each line
+    newline = cls == C_NEWLINE
+    nl_pos = np.flatnonzero(newline)
+    line_of = np.concatenate(([0], np.cumsum(newline, dtype=np.int32)[:-1]))
+    line_starts = np.concatenate(([0], nl_pos + 1))
+    n_lines = len(line_starts)
+
+    def per_line(mask):
+        return np.bincount(line_of[mask], minlength=n_lines)
+
+    # If an odd number of bytes in the mask are on the line up to and
+    # including each byte. Counts wrap around, which keeps their parity.
+    def line_odd(mask):
+        count = np.cumsum(mask, dtype=np.uint8)
+        before = np.concatenate((np.zeros(1, np.uint8), count))[line_starts]
+        return ((count - before[line_of]) & 1).astype(bool)
+
+    # Comments start at the first // of a line that is not in a string and
+    # go to its end. Every quote before it is a real one, so a slash is in
+    # a string if an odd number of quotes come before it on its line.
+    quote = cls == C_QUOTE
+    slash = (cls == C_SLASH) & ~line_odd(quote)
+    comment_at = slash & np.concatenate((slash[1:], [False]))
+    first_comment = np.full(n_lines, n)
+    np.minimum.at(first_comment, line_of[comment_at], idx[comment_at])
+    in_comment = (idx >= first_comment[line_of]) & ~newline
+
+    # Strings. Quotes outside of comments pair up in order and an odd count
+    # on a line means an unterminated string.
+    quote &= ~in_comment
+    open_quote = line_odd(quote)
+    in_string = open_quote | quote
+    string_start = quote & open_quote
+    code = ~in_string & ~in_comment
+    slow = per_line(quote) % 2 == 1
+
+    # Words start at the first letter of a run of letters, digits and
+    # underscores and take the rest of the run. Digits before it are numbers.
+    wordchar = code & ((cls == C_ALPHA) | (cls == C_DIGIT) | (cls == C_UNDER))
+    run_start = wordchar & ~np.concatenate(([False], wordchar[:-1]))
+    alpha = np.cumsum(code & (cls == C_ALPHA), dtype=np.int32)
+    run_base = np.maximum.accumulate(np.where(run_start, alpha - (cls == C_ALPHA), 0))
+    in_word = wordchar & (alpha - run_base > 0)
+    word_start = in_word & ~np.concatenate(([False], in_word[:-1]))
+
+    # Numbers are runs of digits and dots outside of words and must start
+    # with a digit and have at most one dot
+    numchar = code & ~in_word & ((cls == C_DIGIT) | (cls == C_DOT))
+    num_start = numchar & ~np.concatenate(([False], numchar[:-1]))
+    num_id = np.cumsum(num_start, dtype=np.int32) - 1
+    dots = np.bincount(num_id[numchar & (cls == C_DOT)], minlength=int(num_start.sum()))
+    bad = code & (cls == C_UNDER) & ~in_word
+    bad |= num_start & (cls == C_DOT)
+    bad[numchar] |= dots[num_id[numchar]] > 1
+    bad |= code & (cls == C_OTHER)
+
+    # Symbol runs are split greedily into doubles and singles, one offset
+    # into the runs at a time
+    symchar = code & ((cls == C_SYMBOL) | (cls == C_SLASH)) & ~comment_at
+    sym_start = symchar & ~np.concatenate(([False], symchar[:-1]))
+    pair = np.zeros(n, np.uint8)
+    pair[:-1] = doubles[data[:-1].astype(np.uint16) << 8 | data[1:]]
+    pair[:-1] *= symchar[1:]
+    is_start = sym_start.copy()
+    offset = idx - np.maximum.accumulate(np.where(sym_start, idx, 0))
+    for k in range(1, int(offset[symchar].max(initial=0)) + 1):
+        at = np.flatnonzero(symchar & (offset == k))
+        is_start[at] = ~(is_start[at-1] & (pair[at-1] != 0))
+    is_double = is_start & (pair != 0)
+    bad |= is_start & ~is_double & (singles[data] == 0)
+
+    slow |= per_line(bad) > 0
+    fast = ~slow[line_of]
+    # Lines the arrays do not cover are lexed again by scan, which only
+    # pays off while they are a small part of the source
+    if np.count_nonzero(~fast) > n // 4:
+        return table_buffer(src)
+
+    # Token starts and types on fast lines
+    starts = np.flatnonzero(fast & (word_start | num_start | is_start | string_start | newline))
+    kinds = cls[starts]
+    types = np.where(kinds == C_NEWLINE, NEWLINE, 0).astype(np.uint8)
+    types[num_start[starts]] = NUMBER
+    types[string_start[starts]] = STRING
+    types[word_start[starts]] = IDENTIFIER
+    sym = is_start[starts]
+    types[sym] = np.where(is_double[starts][sym], pair[starts][sym], singles[data[starts][sym]])
+
+    # Tokens end at the next token start or whitespace, strings at their
+    # closing quote and symbols after one or two characters
+    boundary = np.append(~in_string & ((cls == C_SPACE) | newline | in_comment), True)
+    boundary[starts] = True
+    boundary = np.flatnonzero(boundary)
+    ends = boundary[np.searchsorted(boundary, starts, "right")]
+    close = np.flatnonzero(quote & ~string_start)
+    ends[types == STRING] = close[np.searchsorted(close, starts[types == STRING])] + 1
+    ends[sym] = starts[sym] + 1 + (is_double[starts][sym])
+    ends[types == NEWLINE] = starts[types == NEWLINE] + 1
+
+    lines = line_of[starts]
+    cols = starts - line_starts[lines]
+    # A newline after a comment is reported at the comment start
+    commented = (types == NEWLINE) & (first_comment[lines] < n)
+    cols[commented] = first_comment[lines[commented]] - line_starts[lines[commented]]
+
+    flags = np.zeros(len(starts), np.uint8)
+    flags[types == NUMBER] = (dots[num_id[starts[types == NUMBER]]] > 0) * FLAG_FLOAT
+
+    # Keywords. Short words are packed into integers, one byte per letter,
+    # and looked up in the sorted packed keywords.
+    lengths = ends - starts
+    words = np.flatnonzero((types == IDENTIFIER) & (lengths <= 8))
+    packed = np.zeros(len(words), np.uint64)
+    for j in range(int(lengths[words].max(initial=0))):
+        has = lengths[words] > j
+        packed[has] |= data[starts[words[has]] + j].astype(np.uint64) << np.uint64(8 * j)
+    at = np.minimum(np.searchsorted(keywords, packed), len(keywords) - 1)
+    hit = keywords[at] == packed
+    types[words[hit]] = keyword_types[at[hit]]
+
+    # Lex slow lines with scan, a run of lines at a time. This raises the
+    # first error, fast lines have none.
+    buf = TokenBuffer(src, LineTable(src))
+    line_ends = np.append(nl_pos + 1, n)
+    slow_lines = np.flatnonzero(slow)
+    if len(slow_lines):
+        breaks = np.flatnonzero(np.diff(slow_lines) != 1)
+        firsts = slow_lines[np.concatenate(([0], breaks + 1))]
+        lasts = slow_lines[np.append(breaks, len(slow_lines) - 1)]
+        for first, last in zip(firsts.tolist(), lasts.tolist()):
+            scan(buf, int(line_starts[first]), int(line_ends[last]), first + 1)
+
+    # Merge fast and slow tokens by source offset
+    columns = (types, starts, lengths, lines + 1, cols, flags)
+    merged = [np.concatenate((c, np.frombuffer(b, b.typecode).astype(c.dtype)))
+              for c, b in zip(columns, buffer_columns(buf))] if len(buf) else list(columns)
+    order = np.argsort(merged[1], kind="stable")
+    for column, values in zip(buffer_columns(buf), merged):
+        dtype = np.dtype(column.typecode)
+        data = values[order].astype(dtype).tobytes()
+        del column[:]
+        column.frombytes(data)
 
-    return tokens
\ No newline at end of file
+    return buf
@@ -1,12 +1,171 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import lexer
 import parser
+import util
+import stats
+from error import NeonSyntaxError
+from intern import Interner
+from cache import ParseCache
+from memory import memory_report
+import export
+
+def main(filename: str, stream: bool = False, share: bool = False, cache: str = None, emit: str = None) -> str:
+    # Streaming reads the file through a memory map and parses one
+    # statement at a time instead of holding all tokens at once.
+    if stream:
+        tree = parser.parse_stream(lexer.iter_tokens(lexer.map_file(filename)))
+        output(tree, emit)
+        return
 
-def main(filename: str) -> str:
     with open(filename) as f:
         source = f.read()
-        tokens = lexer.get_tokens(source)
-        tree   = parser.parse_tokens(tokens)
+
+        # Unchanged files are loaded from the cache directory if given
+        store = ParseCache(cache) if cache else None
+        tree  = store.load(source) if store else None
+        if tree is None:
+            tokens = lexer.get_token_buffer(source)
+            tree   = parser.parse_tokens(tokens)
+            if store:
+                store.store(source, tree, tokens)
+
+        # Shares identical constant subtrees between statements
+        if share:
+            interner = Interner()
+            interner.intern_tree(tree)
+            print(interner.report())
+
+        output(tree, emit)
+
+# Prints the tree, or writes it to the emit file as json lines
+def output(tree, emit: str = None):
+    if emit is None:
         tree.print()
+        return
+
+    with open(emit, "w") as f:
+        export.write_tree(tree, f)
+
+# Lexes and parses every .ne file in the given files and directories on a
+# process pool. Diagnostics are returned by the workers and printed in file
+# order, so the output does not depend on scheduling. Returns the number
+# of files with errors.
+def compile_files(paths: list[str], jobs: int = None, cache: str = None) -> int:
+    files = collect_files(paths)
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(files) <= 1:
+        return report((compile_file(f, cache), None) for f in files)
+
+    # Bigger chunks cut messaging overhead, several per worker keep the
+    # load balanced when file sizes differ
+    chunksize = max(1, len(files) // (jobs * 4))
+    work = partial(compile_task, cache=cache, collect=stats.enabled)
+    with ProcessPoolExecutor(jobs) as pool:
+        return report(pool.map(work, files, chunksize=chunksize))
+
+# Prints diagnostics and adds worker stats. Results are pairs of diagnostics
+# and a stats snapshot or None.
+def report(results) -> int:
+    failed = 0
+    for diagnostics, snapshot in results:
+        if snapshot is not None:
+            stats.merge(snapshot)
+        for d in diagnostics:
+            print(d)
+        if diagnostics:
+            failed += 1
+    return failed
+
+# Files in the order given, directories are searched for .ne files in
+# sorted order. Each file is only included once.
+def collect_files(paths: list[str]) -> list[str]:
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, n) for n in sorted(names) if n.endswith(".ne"))
+
+    return list(dict.fromkeys(files))
+
+# Runs compile_file in a worker process. Returns its diagnostics and, if
+# collecting, the stats of this file only.
+def compile_task(filename: str, cache: str = None, collect: bool = False) -> tuple:
+    if not collect:
+        return compile_file(filename, cache), None
+
+    stats.enable()
+    stats.reset()
+    return compile_file(filename, cache), stats.snapshot()
+
+# Lexes and parses a single file in a worker. Diagnostics are rendered and
+# returned instead of printed, and nothing exits the process.
+def compile_file(filename: str, cache: str = None) -> list[str]:
+    try:
+        with open(filename) as f:
+            source = f.read()
+    except OSError as e:
+        return [f"{util.red('error:')} cannot read {filename}: {e.strerror}\n"]
+
+    # Only trees without errors are cached
+    store = ParseCache(cache) if cache else None
+    if store and store.load(source) is not None:
+        return []
+
+    try:
+        tokens = lexer.lex_buffer(source)
+    except NeonSyntaxError as err:
+        errors = [err]
+    else:
+        p = parser.Parser(tokens)
+        tree = p.parse()
+        errors = p.errors
+        if store and not errors:
+            store.store(source, tree, tokens)
+
+    for err in errors:
+        err.file = filename
+    return [str(err) for err in errors]
 
 if __name__ == "__main__":
-    main("../main.ne")
+    cli = argparse.ArgumentParser(description="Neon compiler")
+    cli.add_argument("paths", nargs="*", help="source files and directories")
+    cli.add_argument("-j", "--jobs", type=int, help="number of worker processes")
+    cli.add_argument("--cache", help="parse cache directory")
+    cli.add_argument("--stream", action="store_true", help="stream a single file")
+    cli.add_argument("--share", action="store_true", help="share identical subtrees")
+    cli.add_argument("--stats", action="store_true", help="print phase times and counters")
+    cli.add_argument("--memory", action="store_true", help="print a memory report for each file")
+    cli.add_argument("--emit-ast", metavar="FILE", help="write the tree of a single file as json lines")
+    args = cli.parse_args()
+    stats.enable(args.stats)
+
+    # A single file is parsed and printed, several files or a directory
+    # are compiled as a batch
+    paths = args.paths or ["../main.ne"]
+    single = len(paths) == 1 and not os.path.isdir(paths[0])
+    if not single and not args.memory:
+        for flag, name in ((args.stream, "--stream"), (args.share, "--share"), (args.emit_ast, "--emit-ast")):
+            if flag:
+                cli.error(f"{name} takes a single file")
+
+    failed = 0
+    if args.memory:
+        for filename in collect_files(paths):
+            with open(filename) as f:
+                print(memory_report(f.read(), filename), end="\n\n")
+    elif single:
+        main(paths[0], args.stream, args.share, args.cache, args.emit_ast)
+    else:
+        failed = compile_files(paths, args.jobs, args.cache)
+
+    if args.stats:
+        print(stats.report())
+    if failed != 0:
+        exit(1)
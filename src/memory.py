@@ -0,0 +1,118 @@
+import os
+import sys
+import linecache
+import tracemalloc
+from lexer import get_tokens
+from parser import Parser
+from tokens import *
+import ast
+
+# Memory report of lexing and parsing one source. Each phase is traced with
+# tracemalloc for its peak and for what it still holds when done, and the
+# structures that are left are sized with sys.getsizeof.
+class MemoryReport:
+    def __init__(self, name: str):
+        self.name = name
+        self.phases = []     # (phase, peak bytes, retained bytes)
+        self.structures = [] # (structure, bytes, count)
+        self.sites = []      # (file:line, code, bytes) of the largest allocations
+        self.tokens = 0
+        self.nodes = 0
+
+    def retained(self, phase: str) -> int:
+        return next(r for p, _, r in self.phases if p == phase)
+
+    def __str__(self) -> str:
+        mb = lambda n: f"{n/(1<<20):9.2f} MB"
+        lines = [f"memory report for {self.name}", "", f"{'phase':24} {'peak':>12} {'retained':>12}"]
+        for phase, peak, retained in self.phases:
+            lines.append(f"{phase:24} {mb(peak)} {mb(retained)}")
+
+        lines += ["", f"{'structure':24} {'size':>12} {'count':>10} {'per item':>10}"]
+        for name, size, count in self.structures:
+            per = f"{size / count:8.1f} B" if count else ""
+            lines.append(f"{name:24} {mb(size)} {count:10} {per:>10}")
+
+        lines.append("")
+        if self.tokens:
+            lines.append(f"bytes per token {self.retained('lex') / self.tokens:10.1f}")
+        if self.nodes:
+            lines.append(f"bytes per node  {self.retained('parse') / self.nodes:10.1f}")
+
+        lines += ["", "largest allocation sites"]
+        for site, code, size in self.sites:
+            lines.append(f"  {site:16} {mb(size)}  {code}")
+        return "\n".join(lines)
+
+# Lexes and parses the source under tracemalloc. The parser is kept alive
+# until its structures are measured.
+def memory_report(src: str, name: str = "<source>", sites: int = 8) -> MemoryReport:
+    report = MemoryReport(name)
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+
+    try:
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        tokens = get_tokens(src)
+        current, peak = tracemalloc.get_traced_memory()
+        report.phases.append(("lex", peak - base, current - base))
+
+        base = current
+        tracemalloc.reset_peak()
+        parser = Parser(tokens)
+        tree = parser.parse()
+        current, peak = tracemalloc.get_traced_memory()
+        report.phases.append(("parse", peak - base, current - base))
+
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:sites]:
+            frame = stat.traceback[0]
+            site = f"{os.path.basename(frame.filename)}:{frame.lineno}"
+            report.sites.append((site, linecache.getline(frame.filename, frame.lineno).strip(), stat.size))
+    finally:
+        if started:
+            tracemalloc.stop()
+
+    nodes = list(ast.walk(tree))
+    report.tokens = len(tokens)
+    report.nodes = len(nodes)
+    report.structures = [
+        ("token list", token_list_size(tokens), len(tokens)),
+        ("line tables", line_table_size(tokens), len(tokens)),
+        ("ast nodes", sum(sys.getsizeof(n) for n in nodes), len(nodes)),
+        ("signatures", sum(signature_size(n.signature) for n in nodes), len(nodes)),
+        ("parser stacks", parser_size(parser), parser.len),
+    ]
+    return report
+
+# The list, its Token objects and their lexeme strings
+def token_list_size(tokens: list[Token]) -> int:
+    size = sys.getsizeof(tokens)
+    lexemes = {}
+    for t in tokens:
+        size += sys.getsizeof(t)
+        lexemes[id(t.lexeme)] = t.lexeme
+    return size + sum(sys.getsizeof(s) for s in lexemes.values())
+
+# Token.string is read from the line table of the token's source, so line
+# text is stored once per source instead of once per token
+def line_table_size(tokens: list[Token]) -> int:
+    tables = {id(t.lines): t.lines for t in tokens}
+    size = 0
+    for lines in tables.values():
+        size += sys.getsizeof(lines) + sys.getsizeof(lines.src) + sys.getsizeof(lines.starts)
+        size += sum(sys.getsizeof(s) for s in lines.starts if s > 256) # Small ints are shared
+    return size
+
+def signature_size(sig: Signature) -> int:
+    size = sys.getsizeof(sig) + sys.getsizeof(sig.parts)
+    if sig._digest is not None:
+        size += sys.getsizeof(sig._digest)
+    return size
+
+# Token types, bracket index and window stack of the parser
+def parser_size(parser: Parser) -> int:
+    size = sys.getsizeof(parser.types) + sys.getsizeof(parser.match) + sys.getsizeof(parser.unmatched)
+    size += sys.getsizeof(parser.frames) + sum(sys.getsizeof(w) for w in parser.frames)
+    return size + sys.getsizeof(parser.idxs)
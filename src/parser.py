@@ -1,45 +1,187 @@
+from array import array
+import copy
 from tokens import *
 from error import *
 import ast
-
-def parse_tokens(tokens: list[Token]) -> ast.AstNode:
-    parser = Parser(tokens)
+import stats
+
+# Parses token list or buffer. Token objects are only created from a
+# TokenBuffer as the parser reaches them. Prints errors and exits if there
+# are any. Function bodies are parsed on first access if lazy, which raises
+# the first error in the body.
+def parse_tokens(tokens: list[Token] | TokenBuffer, lazy: bool = False) -> ast.AstNode:
+    parser = Parser(tokens, lazy=lazy)
     tree = parser.parse()
     if parser.err_count != 0:
+        for err in parser.errors:
+            print(err)
         exit(1)
     
     return tree
 
+# Parses a token stream, such as lexer.iter_tokens, one statement at a time.
+# Only the tokens of the current statement are kept, so memory is bounded by
+# the largest statement instead of the whole file. Exits on error.
+@error_prone
+def parse_stream(tokens) -> ast.AstNode:
+    parser = StreamParser(tokens)
+    tree = ast.AstNode()
+    tree.stmts.extend(parser)
+    if parser.err_count != 0:
+        for err in parser.errors:
+            print(err)
+        exit(1)
+
+    return tree
+
+# Matches brackets in one pass over the token types. Returns the index of
+# the matching bracket for each bracket token (-1 for other tokens) and a
+# sorted list of indecies of brackets without a match.
+def bracket_index(types) -> tuple[array, list[int]]:
+    match = array("q", [-1]) * len(types)
+    unmatched = []
+    openers = []
+    for i, t in enumerate(types):
+        if t in bracket_pairs:
+            openers.append(i)
+        elif t in bracket_closers:
+            if len(openers) != 0 and types[openers[-1]] == bracket_closers[t]:
+                j = openers.pop()
+                match[i], match[j] = j, i
+            else:
+                unmatched.append(i)
+
+    unmatched.extend(openers)
+    unmatched.sort()
+    return match, unmatched
+
+# Range of indecies [start, end) in the token array of a parser. Empty
+# windows are falsy, like the token lists they replace.
+class Window:
+    __slots__ = ("start", "end")
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.end = end
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+# Iterator over the statements of a token stream. Tokens are collected until
+# a newline outside of brackets, and each collected statement is parsed on
+# its own. The newline is kept as the start of the next statement, and
+# newlines at the end are parsed with the last one, which gives the same
+# tree as parsing the whole token list at once.
+class StreamParser:
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.errors = []
+
+    def __iter__(self):
+        pending = []
+        last = None
+        depth = 0
+        content = False
+        for tok in self.tokens:
+            t = tok.type
+            if t == NEWLINE and depth <= 0 and content:
+                if last is not None:
+                    yield from self.parse(last)
+                last = pending
+                pending = []
+                depth = 0
+                content = False
+            elif t in bracket_pairs:
+                depth += 1
+            elif t in bracket_closers:
+                depth -= 1
+
+            if t != NEWLINE:
+                content = True
+            pending.append(tok)
+
+        # Newlines at the end are parsed with the last statement. Whether they
+        # make an empty statement depends on how that statement ends.
+        if last is not None and not content:
+            last.extend(pending)
+            pending = []
+        if last is not None:
+            yield from self.parse(last)
+        if pending:
+            yield from self.parse(pending)
+
+    def parse(self, tokens: list[Token]) -> list[ast.Stmt]:
+        parser = Parser(tokens)
+        tree = parser.parse()
+        self.errors.extend(parser.errors)
+        return tree.stmts
+
+    @property
+    def err_count(self) -> int:
+        return len(self.errors)
+
 class Parser:
-    def __init__(self, tokens: list[Token]):
+    def __init__(self, tokens: list[Token] | TokenBuffer, legacy_expr: bool = False, lazy: bool = False):
         self.line = 1
-        self.err_count = 0
-        # Current token list that is being parsed. Expressions usually
-        # have recursive calls so a token list stack gives depth without
-        # recursion and creating multiple objects.
-        self.list = [tokens]
-        # List of indecies from token stack
+        # Syntax errors in source order. Parsing continues after an error
+        # at the next statement, the caller decides how to report them.
+        self.errors = []
+        # Leave function bodies unparsed until they are first accessed.
+        # Gives fast outlines of function declarations.
+        self.lazy = lazy
+        # Use the original splitting expression parser instead of the
+        # precedence climbing one. Kept for comparison.
+        self.legacy_expr = legacy_expr
+        # Shared token array and its token types. Types are read directly
+        # so a TokenBuffer only creates the Token objects that are used.
+        self.toks = tokens
+        self.types = tokens.types if type(tokens) == TokenBuffer else [t.type for t in tokens]
+        # Index of matching bracket for each bracket token, lets seek jump
+        # over nested groups. Unmatched brackets are reported before parsing.
+        self.match, self.unmatched = bracket_index(self.types)
+        # Window of the token array that is being parsed. Expressions usually
+        # have recursive calls so a window stack gives depth without
+        # recursion and copying the tokens.
+        self.frames = [Window(0, len(tokens))]
+        # List of indecies from window stack, relative to window start
         self.idxs = [0]
-        # Index of current token list (always last)
+        # Index of current window (always last)
         self.ptr = 0
 
-    # Parses token list. Returns AST. Exits on error
+    # Parses token list. Returns AST. Errors are added to self.errors
     def parse(self) -> ast.AstNode:
         tree = ast.AstNode()
-        while self.idx < self.len:
-            try:
-                tree.stmts.append(self.stmt())
-            except NeonSyntaxError as err:
-                self.err_count += 1
-                self.idxs = [self.idxs[0]]
-                self.list = [self.list[0]]
-                self.ptr = 0
-                print(err)
-
+        top = self.ptr == 0
+        if top and len(self.unmatched) != 0:
+            self.bracket_errors()
+            return tree
+
+        with stats.phase("parse"):
+            while self.idx < self.len:
+                try:
+                    tree.stmts.append(self.stmt())
+                except NeonSyntaxError as err:
+                    self.errors.append(err)
+                    self.idxs = [self.idxs[0]]
+                    self.frames = [self.frames[0]]
+                    self.ptr = 0
+
+        if top and stats.enabled:
+            stats.count("parser.nodes", ast.tree_size(tree)[0])
         return tree
 
+    @property
+    def err_count(self) -> int:
+        return len(self.errors)
+
+    # Reports each unmatched bracket once
+    def bracket_errors(self):
+        for i in self.unmatched:
+            tok = self.toks[i]
+            self.errors.append(NeonSyntaxError("unmatched brackets", tok.line, tok.col, tok.col+1, tok.lines))
+
     # Shorthand for invoking a procedure on a new stack frame
-    def proc(self, tokens: list[Token], func) -> any:
+    def proc(self, tokens: Window, func) -> any:
         self.push(tokens)
         v = func()
         self.pop()
@@ -53,21 +195,37 @@ class Parser:
             
             node.start = self.first.col
             node.stop = self.last.col + len(self.last.lexeme)
-            node.string = self.first.string
+            node.lines = self.first.lines
             node.line = self.line
             return node
         
         return wrap
 
-    # Parses single statement
-    @wrap_ast_node
+    # Parses single statement. Its position is the part of its first line
+    # it covers, so it does not depend on the statements around it.
     def stmt(self) -> ast.Stmt:
         # Remove prefixed newline characters
-        while self.idx < self.len-1 and self.current.type == NEWLINE:
+        while self.idx < self.len-1 and self.current_type == NEWLINE:
             self.next()
 
-        self.line = self.current.line
-        t = self.current.type
+        self.line = line = self.current.line
+        start = self.idx
+        node = self.stmt_kind()
+
+        types, base = self.types, self.frame.start
+        end = start
+        while end+1 < self.idx and types[base+end+1] != NEWLINE:
+            end += 1
+        first, last = self.at(start), self.at(end)
+        node.start = first.col
+        node.stop = last.col if last.type == NEWLINE else last.col + len(last.lexeme)
+        node.lines = first.lines
+        node.line = line
+        return node
+
+    # Parses the statement starting at the current token
+    def stmt_kind(self) -> ast.Stmt:
+        t = self.current_type
 
         # Return statement. Return outside func checked in scan.
         if t == RETURN:
@@ -105,27 +263,28 @@ class Parser:
             while not self.eof:
                 if len(params) != 0: self.expect(COMMA, "comma")
                 name = self.expect(IDENTIFIER, "parameter name")
-                params.append(ast.Param(name.lexeme, self.type()))
+                params.append(ast.Param(name.lexeme, self.type(), name))
             
             self.pop()
 
             return_t = self.type(True)
-            block = self.block()
-            return ast.Function(func_name.lexeme, params, return_t, block)
+            block = self.deferred_block() if self.lazy else self.block()
+            return ast.Function(func_name.lexeme, params, return_t, block, func_name)
 
-        # Variable declaration
-        if var := self.seek(COLON_EQUAL):
-            if len(var) != 1 or var[0].type != IDENTIFIER:
+        # Variable declaration. Declarations and assignments are only
+        # searched for up to the end of the statement's line.
+        if var := self.seek(COLON_EQUAL, stop=NEWLINE):
+            if len(var) != 1 or self.types[var.start] != IDENTIFIER:
                 self.range_err("expected identifier on left side of ':='", var, True)
 
             expr = self.proc(self.seek(NEWLINE), self.expr)
-            return ast.Declaration(var[0], expr)
+            return ast.Declaration(self.toks[var.start], expr)
 
         # Todo: parse variable declaration with type
 
         # Assignment. Left side is expression in case of
         # indexing or struct property, checked in scan.
-        if var := self.seek(EQUAL):
+        if var := self.seek(EQUAL, stop=NEWLINE):
             left = self.proc(var, self.expr)
             expr = self.proc(self.seek(NEWLINE), self.expr)
             return ast.Assignment(left, expr)
@@ -139,13 +298,151 @@ class Parser:
         block = self.proc(self.seek(RIGHT_BRACE), self.parse)
         return ast.Block(block.stmts)
 
+    # Consumes block statement without parsing it. The returned handle
+    # parses the block on a forked parser when it is first needed.
+    def deferred_block(self) -> ast.Deferred:
+        self.expect(LEFT_BRACE, "block")
+        window = self.seek(RIGHT_BRACE)
+        frame = Window(window.start, window.end)
+        return ast.Deferred(lambda: self.fork(frame).deferred_body())
+
+    # Parses the whole current frame as the statements of a block
+    def block_body(self) -> ast.Block:
+        return ast.Block(self.parse().stmts)
+
+    # Parses a deferred block. The parse that skipped the block has already
+    # returned, so the first error is raised to the code accessing the body.
+    def deferred_body(self) -> ast.Block:
+        block = self.block_body()
+        if self.err_count != 0:
+            raise self.errors[0]
+        return block
+
+    # Returns a parser over the given window of the same token array.
+    # Shares the token and bracket arrays, but has its own stack.
+    def fork(self, window: Window) -> "Parser":
+        parser = copy.copy(self)
+        parser.errors = []
+        parser.frames = [window]
+        parser.idxs = [0]
+        parser.ptr = 0
+        return parser
+
     # Parses single expression
     @wrap_ast_node
     def expr(self) -> ast.Expr:
+        if self.legacy_expr:
+            return self.split_expr()
+        return self.climb_expr()
+
+    # Parses expression in a single left to right pass using precedence
+    # climbing. Produces the same trees as split_expr.
+    def climb_expr(self) -> ast.Expr:
         if self.len == 0:
             return ast.Empty()
 
-        t = self.current.type
+        expr = self.args_expr()
+        if not self.eof:
+            self.err("invalid expression", True, self.current)
+
+        return expr
+
+    # Argument list expression. Expressions seperated by comma
+    def args_expr(self) -> ast.Expr:
+        start = self.idx
+        expr = self.binary_expr(0)
+        if self.eof or self.current_type != COMMA:
+            return expr
+
+        args = [expr]
+        while not self.eof and self.current_type == COMMA:
+            self.next()
+            if self.eof or self.current_type == COMMA:
+                args.append(ast.Empty())
+                continue
+            args.append(self.binary_expr(0))
+
+        return self.place(ast.Args(args), start)
+
+    # Binary expression with operators binding at least as tight as min_prec.
+    # Operators of the same precedence are left associative.
+    def binary_expr(self, min_prec: int) -> ast.Expr:
+        start = self.idx
+        left = self.unary_expr()
+        while not self.eof:
+            op = self.current
+            prec = binary_precedence.get(op.type, -1)
+            if prec < min_prec:
+                break
+
+            self.next()
+            right = self.binary_expr(prec + 1)
+            left = self.place(ast.Binary(left, right, op), start)
+
+        return left
+
+    # Unary expression, binds tighter than any binary operator
+    def unary_expr(self) -> ast.Expr:
+        if self.eof:
+            self.err("invalid expression", True, self.last)
+
+        if self.current_type in unary_ops:
+            start, op = self.idx, self.current
+            self.next()
+            return self.place(ast.Unary(self.unary_expr(), op), start)
+
+        return self.call_expr()
+
+    # Primary expression followed by any number of call argument groups
+    def call_expr(self) -> ast.Expr:
+        start = self.idx
+        expr = self.primary_expr()
+        while not self.eof and self.current_type == LEFT_PAREN:
+            inner = self.paren_expr()
+            expr = self.place(ast.Call(expr, inner), start)
+
+        return expr
+
+    # Literal, variable or group expression
+    def primary_expr(self) -> ast.Expr:
+        start, tok = self.idx, self.current
+        if tok.type == LEFT_PAREN:
+            inner = self.paren_expr()
+            if ast.is_empty(inner):
+                self.err("invalid expression", True, tok)
+            return self.place(ast.Group(inner), start)
+
+        self.next()
+        if tok.type == IDENTIFIER:
+            return self.place(ast.Variable(tok), start)
+        if tok.type in literal_types:
+            return self.place(ast.Literal(tok), start)
+
+        self.err("invalid expression", True, tok)
+
+    # Parses the expression inside parens. Consumes the parens
+    def paren_expr(self) -> ast.Expr:
+        self.next()
+        inner = self.seek(RIGHT_PAREN, True)
+        return self.proc(inner, self.expr)
+
+    # Sets the position of a node built from the tokens between start and
+    # the current token
+    def place(self, node: ast.Expr, start: int) -> ast.Expr:
+        first, last = self.at(start), self.at(self.idx-1)
+        node.start = first.col
+        node.stop = last.col + len(last.lexeme)
+        node.lines = first.lines
+        node.line = self.line
+        return node
+
+    # Parses expression by splitting the token list at the operator with
+    # the lowest precedence, recursing into each side
+    def split_expr(self) -> ast.Expr:
+        if self.len == 0:
+            return ast.Empty()
+
+        t = self.current_type
 
         # Literal or variable expression
         if self.len == 1:
@@ -176,7 +473,7 @@ class Parser:
                 continue
 
             # Magic to parse unary expressions
-            if left[len(left)-1].type in binary_ops:
+            if self.types[left.end-1] in binary_ops:
                 continue
 
             l, r = self.proc(left, self.expr), self.proc(right, self.expr)
@@ -184,7 +481,7 @@ class Parser:
 
         # Unary expression
         if self.first.type in unary_ops:
-            return ast.Unary(self.proc(self.tokens[1:], self.expr), self.first)
+            return ast.Unary(self.proc(self.window(1, self.len), self.expr), self.first)
 
         # Call expression. Last 'part' of expression has to be a group
         if self.last.type == RIGHT_PAREN:
@@ -196,7 +493,7 @@ class Parser:
                     continue
 
                 # Get callee expression
-                left = self.tokens[:self.len-len(grp)-2]
+                left = self.window(0, self.len-len(grp)-2)
                 callee = self.proc(left, self.expr)
                 inner  = self.proc(grp, self.expr)
                 return ast.Call(callee, inner)
@@ -205,7 +502,7 @@ class Parser:
 
     # Parse and consume type name (with prefixed colon)
     def type(self, optional: bool = False) -> ast.Type:
-        if optional and not self.eof and self.current.type != COLON:
+        if optional and not self.eof and self.current_type != COLON:
             return ast.Type(typeword_lookup["none"])
         
         self.expect(COLON, "':' before type")
@@ -220,18 +517,24 @@ class Parser:
     # The parser uses a stack to control which tokens are currently being parsed.
     # This architecture allows generic helper methods to be used for any expression
     # or statement. It also handles iteration and nesting in the background.
+    # Frames are windows over one shared token array, so nesting never copies tokens.
 
-    def push(self, tokens: list[Token]):
-        self.list.append(tokens)
+    def push(self, tokens: Window):
+        self.frames.append(tokens)
         self.idxs.append(0)
         self.ptr += 1
+        if stats.enabled:
+            stats.count("parser.push")
+            stats.peak("parser.depth", self.ptr)
 
     def pop(self):
         if self.ptr == 0:
             return
-        self.list.pop()
+        self.frames.pop()
         self.idxs.pop()
         self.ptr -= 1
+        if stats.enabled:
+            stats.count("parser.pop")
 
     def next(self):
         self.idx += 1
@@ -240,11 +543,20 @@ class Parser:
         self.idx -= 1
 
     def at(self, idx: int) -> Token:
-        return self.tokens[idx]
+        return self.toks[self.frame.start + idx]
+
+    # Returns window of the current frame from start to end (relative)
+    def window(self, start: int, end: int) -> Window:
+        return Window(self.frame.start + start, self.frame.start + end)
 
     @property
     def current(self) -> Token:
-        return self.tokens[self.idx]
+        return self.toks[self.frame.start + self.idx]
+
+    # Type of current token, does not create a token object
+    @property
+    def current_type(self) -> int:
+        return self.types[self.frame.start + self.idx]
 
     @property
     def idx(self) -> int:
@@ -256,23 +568,23 @@ class Parser:
 
     @property
     def len(self) -> int:
-        return len(self.tokens)
+        return len(self.frame)
 
     @property
-    def tokens(self) -> list[Token]:
-        return self.list[self.ptr]
+    def frame(self) -> Window:
+        return self.frames[self.ptr]
 
     @property
-    def rest(self) -> list[Token]:
-        return self.tokens[self.idx:]
+    def rest(self) -> Window:
+        return self.window(self.idx, self.len)
 
     @property
     def first(self) -> Token:
-        return self.tokens[0]
+        return self.at(0)
 
     @property
     def last(self) -> Token:
-        return self.tokens[self.len-1]
+        return self.at(self.len-1)
 
     @property
     def eof(self) -> bool:
@@ -283,95 +595,92 @@ class Parser:
     # Add error to stack, terminates parsing if fatal
     def err(self, msg: str, fatal: bool = False, point: Token = None):
         first, last = self.first.col, self.last.col + len(self.last.lexeme)
-        string, line = self.first.string, self.line
+        lines, line = self.first.lines, self.line
 
         # Specify token to highlight as err. Set error msg to tokens line
         if point != None:
             first, last = point.col, point.col+len(point.lexeme)
-            string, line = point.string, point.line
+            lines, line = point.lines, point.line
 
         if self.eof: first += 1
-        raise NeonSyntaxError(msg, line, first, last, string)
+        raise NeonSyntaxError(msg, line, first, last, lines)
 
     # Highlights specified token range in error
-    def range_err(self, msg: str, tokens: list[Token], fatal: bool = False):
+    def range_err(self, msg: str, tokens: Window, fatal: bool = False):
         self.proc(tokens, lambda: self.err(msg, fatal))
 
     # Expects and consumes single token. Return token
     def expect(self, tok: int, name: str) -> Token:
         if self.eof:
             self.err(f"expected {name}", True, self.last)
-        if self.current.type != tok:
+        if self.current_type != tok:
             self.err(f"expected {name}", True, self.current)
         t = self.current
         self.next()
         return t
 
-    # Returns the tokens between curIdx and end_t. Empty list
-    # on failure (falsy). Consumes end token.
-    def seek(self, end_t: int, expect: bool = False) -> list[Token]:
-        pairs = {
-            LEFT_PAREN: RIGHT_PAREN,
-            LEFT_SQUARE: RIGHT_SQUARE,
-            LEFT_BRACE: RIGHT_BRACE
-        }
-
-        # Loops until EOF. If a token is a pair starter
-        # it is appended to the closers stack. The closing
-        # token must be found before end_t can be matched.
-        interval = []
-        closers = []
-        opening = None
+    # Returns the window between curIdx and end_t. Empty window
+    # on failure (falsy), or when the stop token is reached first.
+    # Consumes end token.
+    def seek(self, end_t: int, expect: bool = False, stop: int = None) -> Window:
+        types = self.types
+        base = self.frame.start
+
+        # Loops until EOF. If a token is a pair starter the
+        # loop jumps to its closing token, so end_t is only
+        # matched outside of brackets.
         start_idx = self.idx
         while not self.eof:
-            t = self.current.type
+            t = types[base + self.idx]
 
-            if len(closers) == 0 and t == end_t:
+            if t == end_t:
                 self.next()
-                return interval
-
-            # If a closing bracket is found before an opening
-            if len(closers) == 0:
-                for _, v in pairs.items():
-                    if t == v:
-                        closers.append(t)
-                if len(closers) > 0:
-                    break
-
-            if t in pairs:
-                opening = self.current
-                closers.append(pairs[t])
-
-            if len(closers) > 0 and t == closers[len(closers)-1]:
-                closers.pop()
-            
-            interval.append(self.current)
+                if stats.enabled:
+                    self.seek_stats(start_idx)
+                return self.window(start_idx, self.idx-1)
+
+            # Give up at the stop token, also outside of brackets
+            if t == stop:
+                break
+
+            # If a closing bracket is found before an opening, or
+            # the group is not closed within the current window
+            if t in bracket_closers:
+                self.err("unmatched brackets", True, self.current)
+
+            if t in bracket_pairs:
+                close = self.match[base + self.idx] - base
+                if close >= self.len:
+                    self.err("unmatched brackets", True, self.current)
+                self.idx = close
+
             self.next()
         
+        if stats.enabled:
+            self.seek_stats(start_idx)
+
         # Exception for newline seek as eof might occur
         if end_t == NEWLINE and self.eof:
-            return interval
+            return self.window(start_idx, self.idx)
         
         # If token is expected, throw error if not found
         if expect and self.eof:
             self.expect(end_t, all_tokens[end_t])
-        
-        # Raise error if opening and closing brackets did
-        # not match. Fallthrough is only if end_t was not found
-        if len(closers) != 0:
-            tok = opening
-            if not self.eof: tok = self.current
-            self.err("unmatched brackets", True, tok)
 
         self.idx = start_idx
-        return []
+        return Window(0, 0)
     
-    # Returns token interval between left and right tokens.
-    # Empty list on failure (falsy). Consumes tokens if valid
-    def group(self, left: int, right: int) -> list[Token]:
+    # Counts a seek and the tokens it passed, including skipped groups
+    def seek_stats(self, start_idx: int):
+        stats.count("parser.seek")
+        stats.count("parser.seek_tokens", self.idx - start_idx)
+
+    # Returns token window between left and right tokens.
+    # Empty window on failure (falsy). Consumes tokens if valid
+    def group(self, left: int, right: int) -> Window:
         start_idx = self.idx
-        if self.current.type != left:
-            return []
+        if self.current_type != left:
+            return Window(0, 0)
 
         self.next()
         interval = self.seek(right)
@@ -380,21 +689,25 @@ class Parser:
 
         return interval
 
-    # Returns token intervals of left and right of tok.
-    # Two empty lists on failure (falsy). Consumes to eof
-    def split(self, tok: int) -> tuple[list, list]:
+    # Returns token windows left and right of tok.
+    # Two empty windows on failure (falsy). Consumes to eof
+    def split(self, tok: int) -> tuple[Window, Window]:
         return self.seek(tok), self.rest
     
     # Same as split but splits as the last instance of the token
-    def split_last(self, tok: int) -> tuple[list, list]:
+    def split_last(self, tok: int) -> tuple[Window, Window]:
         tok_idx = 0
+        iterations = 0
         while not self.eof:
+            iterations += 1
             self.idx = tok_idx
             if not self.seek(tok):
                 break
             tok_idx = self.idx
-        
+
+        if stats.enabled:
+            stats.count("parser.split_last_iterations", iterations)
         if tok_idx == 0:
-            return [], []
+            return Window(0, 0), Window(0, 0)
 
-        return self.tokens[:tok_idx-1], self.tokens[tok_idx:]
\ No newline at end of file
+        return self.window(0, tok_idx-1), self.window(tok_idx, self.len)
@@ -2,5 +2,129 @@ from tokens import *
 from error import *
 import ast
 
+# Definition of a name in scope: a Declaration, a function Param or a
+# Function. Only declared variables get shadowing and unused warnings.
+class Symbol:
+    __slots__ = ("name", "node", "at", "variable", "used")
+
+    def __init__(self, name: str, node, at, variable: bool = False):
+        self.name = name
+        self.node = node
+        self.at = at # Name token, or the node if it has none
+        self.variable = variable
+        self.used = False
+
+# Resolves every Variable in a tree to its definition in one pass. Scopes
+# are a stack of frames, one per Function and Block, each a dict of the
+# names defined in it. All visible definitions of a name are also kept in a
+# single table as a stack, innermost last, so a lookup is one dict access
+# no matter how deeply scopes nest, and leaving a scope pops the names of
+# its frame. Names are interned by the lexer, so the dicts compare keys by
+# identity. Functions are defined when the scope they are in starts, so
+# they can be called before their definition. A declaration's name is in
+# scope after its expression, so x := x + 1 refers to an outer x.
+class DefinitionScanner(ast.Visitor):
+    def __init__(self):
+        self.uses = {}       # Variable node to the node that defines it
+        self.unresolved = [] # Variables that are not defined in scope
+        self.errors = []
+        self.warnings = []
+        self.frames = [{}]
+        self.visible = {}    # Name to its visible symbols, innermost last
+
+    def scan(self, tree: ast.AstNode):
+        self.define_functions(tree.stmts)
+        self.walk(tree.stmts)
+        self.pop_frame()
+        # Unused names are found when their scope ends, report in source order
+        self.warnings.sort(key=lambda w: (w.line, w.start))
+
+    def define(self, sym: Symbol):
+        frame = self.frames[-1]
+        if sym.name in frame:
+            self.error(f"'{sym.name}' is already defined in this scope", sym.at)
+            return
+
+        outer = self.visible.get(sym.name)
+        if outer and sym.variable:
+            self.warn(f"'{sym.name}' shadows an outer definition", sym.at)
+        frame[sym.name] = sym
+        if outer is None:
+            self.visible[sym.name] = [sym]
+        else:
+            outer.append(sym)
+
+    # Leaves the innermost scope. Declarations that were never used are
+    # reported, params and functions are not.
+    def pop_frame(self):
+        for name, sym in self.frames.pop().items():
+            if not sym.used and sym.variable:
+                self.warn(f"'{name}' is declared but not used", sym.at)
+            syms = self.visible[name]
+            syms.pop()
+            if not syms:
+                del self.visible[name]
+
+    def define_functions(self, stmts: list[ast.Stmt]):
+        for stmt in stmts:
+            if type(stmt) == ast.Function:
+                self.define(Symbol(stmt.name, stmt, stmt.ident or stmt))
+
+    def error(self, msg: str, at):
+        self.errors.append(diagnostic(NeonSyntaxError, msg, at))
+
+    def warn(self, msg: str, at):
+        self.warnings.append(diagnostic(NeonWarning, msg, at))
+
+    def visit_Variable(self, node: ast.Variable):
+        syms = self.visible.get(node.token.lexeme)
+        if syms is None:
+            self.unresolved.append(node)
+            return
+        syms[-1].used = True
+        self.uses[node] = syms[-1].node
+
+    def visit_Declaration(self, node: ast.Declaration) -> list:
+        return [node.expr]
+
+    def leave_Declaration(self, node: ast.Declaration):
+        self.define(Symbol(node.ident.lexeme, node, node.ident, True))
+
+    def visit_Block(self, node: ast.Block) -> list:
+        self.frames.append({})
+        self.define_functions(node.stmts)
+        return node.stmts
+
+    def leave_Block(self, node: ast.Block):
+        self.pop_frame()
+
+    # Params and the body share the function's frame
+    def visit_Function(self, node: ast.Function) -> list:
+        self.frames.append({})
+        for p in node.params:
+            self.define(Symbol(p.name, p, p.token or node))
+        self.define_functions(node.body.stmts)
+        return node.body.stmts
+
+    def leave_Function(self, node: ast.Function):
+        self.pop_frame()
+
+# Error or warning at a token, or at a node for names without a token
+def diagnostic(kind: type, msg: str, at) -> NeonSyntaxError:
+    if type(at) == Token:
+        return kind(msg, at.line, at.col, at.col + len(at.lexeme), at.lines)
+    return kind(msg, at.line, at.start, at.stop, at.lines)
+
+# Maps every Variable in the tree to the Declaration, Param or Function it
+# refers to. Warnings are printed, on errors they are printed and the
+# program exits.
 def definition_scan(tree: ast.AstNode) -> dict:
-    pass
\ No newline at end of file
+    scanner = DefinitionScanner()
+    scanner.scan(tree)
+    for w in scanner.warnings:
+        print(w)
+    if scanner.errors:
+        for err in scanner.errors:
+            print(err)
+        exit(1)
+    return scanner.uses
@@ -0,0 +1,83 @@
+import time
+
+# Phase timings and counters of the compiler front end, reported by main
+# with --stats. Nothing is recorded unless enabled, instrumented code checks
+# stats.enabled before counting so the disabled cost is a single lookup.
+enabled = False
+
+times = {}    # Phase name to total seconds
+counters = {} # Counter name to total
+peaks = {}    # Counter name to highest value seen
+
+def enable(on: bool = True):
+    global enabled
+    enabled = on
+
+def reset():
+    times.clear()
+    counters.clear()
+    peaks.clear()
+
+def count(name: str, n: int = 1):
+    counters[name] = counters.get(name, 0) + n
+
+def peak(name: str, value: int):
+    if value > peaks.get(name, 0):
+        peaks[name] = value
+
+# Adds the wall time of a with block to the phase. Nested phases of the
+# same name are only timed once.
+class phase:
+    __slots__ = ("name", "start")
+    active = set()
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        if enabled and self.name not in phase.active:
+            phase.active.add(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            times[self.name] = times.get(self.name, 0) + time.perf_counter() - self.start
+            phase.active.discard(self.name)
+        return False
+
+# Copy of everything recorded, safe to send between processes
+def snapshot() -> dict:
+    return {"times": dict(times), "counters": dict(counters), "peaks": dict(peaks)}
+
+# Adds a snapshot, such as one from a worker process, to the current totals
+def merge(snap: dict):
+    for name, t in snap["times"].items():
+        times[name] = times.get(name, 0) + t
+    for name, n in snap["counters"].items():
+        count(name, n)
+    for name, n in snap["peaks"].items():
+        peak(name, n)
+
+def report() -> str:
+    lines = ["phase                        time"]
+    for name, t in times.items():
+        lines.append(f"{name:24} {t*1000:10.1f} ms")
+
+    lines.append("")
+    lines.append("counter                     value")
+    for name, n in sorted(counters.items()):
+        lines.append(f"{name:24} {n:10}")
+    for name, n in sorted(peaks.items()):
+        lines.append(f"{name + ' (peak)':24} {n:10}")
+
+    # Derived rates
+    seeks = counters.get("parser.seek", 0)
+    if seeks:
+        lines.append(f"{'tokens per seek':24} {counters.get('parser.seek_tokens', 0) / seeks:10.2f}")
+    for name, unit in (("lex", "lexer.tokens"), ("parse", "parser.nodes")):
+        if times.get(name) and counters.get(unit):
+            lines.append(f"{unit + '/s':24} {counters[unit] / times[name]:10.0f}")
+
+    return "\n".join(lines)
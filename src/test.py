@@ -1,8 +1,27 @@
-from lexer import get_tokens
-from parser import parse_tokens
+from lexer import get_tokens, get_token_buffer, iter_tokens, relex, parallel_buffer
+from parser import parse_tokens, parse_stream, Parser, bracket_index
 
 from tokens import *
+from error import NeonSyntaxError
+from intern import Interner
+from arena import to_arena
+from cache import ParseCache
+from main import compile_file, compile_files, collect_files
+from bench import corpora
+from memory import memory_report
+from export import write_tree, load_tree
+from scanner import DefinitionScanner
+from checker import TypeChecker, ANY
+from folder import ConstantFolder
+import ast
+import lexer
+import stats
 import util
+import io
+import json
+import os
+import sys
+import tempfile
 
 cases = []
 
@@ -27,31 +46,162 @@ class TestFunction:
 @test_func
 def TestTokenGeneration():
     text = 'abc 123 \n1.0 "hello"'
-    tokens = get_tokens(text)
-
+    lines = LineTable(text)
     check = [
-        Token(IDENTIFIER, "abc", 1, 0, text[:8], KIND_NONE),
-        Token(NUMBER, "123", 1, 4, text[:8], KIND_NUMBER),
-        Token(NEWLINE, "NEWLINE", 1, 8, text[:8], KIND_NONE),
-        Token(NUMBER, "1.0", 2, 0, text[9:], KIND_NUMBER, True),
-        Token(STRING, 'hello', 2, 4, text[9:], KIND_STRING),
+        Token(IDENTIFIER, "abc", 1, 0, lines, KIND_NONE),
+        Token(NUMBER, "123", 1, 4, lines, KIND_NUMBER),
+        Token(NEWLINE, "NEWLINE", 1, 8, lines, KIND_NONE),
+        Token(NUMBER, "1.0", 2, 0, lines, KIND_NUMBER, True),
+        Token(STRING, 'hello', 2, 4, lines, KIND_STRING),
     ]
-    
+
+    if lines.text(1) != text[:8] or lines.text(2) != text[9:]:
+        raise RuntimeError(f"wrong line text {lines.text(1)!r}, {lines.text(2)!r}")
+
+    compare_tokens(get_tokens(text, legacy=True), check)
+    compare_tokens(get_tokens(text), check)
+
+    # Both lexer engines must produce the same token stream
+    text = 'func f(a: int) {\n\tb := a >= 2.5 // note\n\treturn f(-b, "x y")\n}\n'
+    compare_tokens(get_tokens(text), get_tokens(text, legacy=True))
+
+
+def compare_tokens(tokens: list[Token], check: list[Token]):
+    if len(tokens) != len(check):
+        raise RuntimeError(f"expected {len(check)} tokens, got {len(tokens)}")
+
+    attrs = ("type", "lexeme", "line", "col", "string", "kind", "isfloat")
     for i, t in enumerate(tokens):
-        for attr in t.__dict__.keys():
+        for attr in attrs:
             a = t.__getattribute__(attr)
             b = check[i].__getattribute__(attr)
             if a != b:
                 raise RuntimeError(f"expected {attr} {b}, got {a}, input: {t.lexeme}")
 
 
+@test_func
+def TestTokenBuffer():
+    text = 'func f(a: int) {\n\tb := a >= 2.5 // note\n\treturn f(-b, "x y")\n}\n'
+    buf = get_token_buffer(text)
+    compare_tokens(buf.tokens(), get_tokens(text))
+    compare_tokens(list(buf), get_tokens(text))
+    compare_tokens(buf[3:6], get_tokens(text)[3:6])
+
+    a = parse_tokens(buf).stmts[0].signature
+    b = parse_tokens(get_tokens(text)).stmts[0].signature
+    if a != b:
+        raise RuntimeError(f"expected signature {b}, got {a}")
+
+
+@test_func
+def TestParallelLexing():
+    text = 'func f(a: int) {\n\tb := a >= 2.5 // note\n\treturn f(-b, "x y")\n}\n' * 40
+    chunk = lexer.PARALLEL_CHUNK
+    lexer.PARALLEL_CHUNK = 100
+    try:
+        compare_tokens(parallel_buffer(text, 3).tokens(), get_tokens(text))
+        compare_tokens(get_tokens(text + "x", jobs=2), get_tokens(text + "x"))
+
+        bad = text + 'x := "y\n' + text
+        try:
+            parallel_buffer(bad, 3)
+            raise RuntimeError("expected unterminated string")
+        except NeonSyntaxError as err:
+            if (err.line, err.start, err.string) != (161, 5, 'x := "y'):
+                raise RuntimeError(f"wrong error at line {err.line}, col {err.start}")
+    finally:
+        lexer.PARALLEL_CHUNK = chunk
+
+
+@test_func
+def TestVectorLexing():
+    try:
+        lexer.load_numpy()
+    except ImportError:
+        return # numpy is optional
+
+    text = 'func f(a: int) {\n\tb := a >= 2.5 // note\n\treturn f(-b, "x / y") && c_1\n}\n12ab := 1.'
+    compare_tokens(get_tokens(text, vector=True), get_tokens(text))
+    for bad in ('x := "y\n', "a := 1.2.3\n", "a := _b\n"):
+        try:
+            lexer.vector_buffer(text + "\n" + bad + text)
+            raise RuntimeError(f"expected error in {bad!r}")
+        except NeonSyntaxError as err:
+            if err.line != 6:
+                raise RuntimeError(f"expected error on line 6, got {err.line}")
+
+
+@test_func
+def TestIncrementalLexing():
+    text = 'a := 1\nb := "hi" // note\nc := a + 2\n'
+    edits = [
+        (5, 1, "22"),      # Replace number
+        (8, 0, "x := 3\n"), # Insert line
+        (14, 1, " + "),    # Join lines
+        (1, 0, "\n\n"),    # Split a line before earlier edits
+        (30, 3, ""),       # Delete part of a comment
+        (45, 0, "d := 1"), # Append a line without a newline
+        (0, 0, '"'),       # Unterminated string
+    ]
+
+    tokens = get_tokens(text)
+    lines = tokens[0].lines
+    for offset, removed, inserted in edits[:-1]:
+        text = text[:offset] + inserted + text[offset+removed:]
+        compare_tokens(relex(tokens, lines, offset, removed, inserted), get_tokens(text))
+        check = get_tokens(text)[0].lines
+        if lines.src != text or [lines.start(i) for i in range(len(lines))] != check.starts:
+            raise RuntimeError(f"line table out of date after edit at {offset}")
+
+    try:
+        relex(tokens, lines, *edits[-1])
+        raise RuntimeError("expected unterminated string error")
+    except NeonSyntaxError:
+        compare_tokens(tokens, get_tokens(text))
+
+
+@test_func
+def TestStreamParsing():
+    text = 'func f(a: int) {\n\tb := a >= 2.5 // note\n\treturn f(-b, "x y")\n}\n\nf(1)\n\n'
+    compare_tokens(list(iter_tokens(text.encode())), get_tokens(text))
+
+    # Blank lines between and after statements, and a single newline at
+    # the end, give the same statements as parsing all tokens at once
+    for text in (text, "a := 1\n", "\na := 1\n\n\nf(a)\n", "a := 1\n\n", "func f() {\n\treturn 1\n}\n"):
+        a = parse_stream(iter_tokens(text))
+        b = parse_tokens(get_tokens(text))
+        if len(a.stmts) != len(b.stmts):
+            raise RuntimeError(f"expected {len(b.stmts)} statements, got {len(a.stmts)}")
+        for x, y in zip(a.stmts, b.stmts):
+            if x.signature != y.signature:
+                raise RuntimeError(f"expected signature {y.signature}, got {x.signature}")
+
+
+@test_func
+def TestStatementLines():
+    # ':=' and '=' are only searched for on the statement's own line, so an
+    # expression statement is not joined with a declaration or assignment
+    # on a later line
+    cases = [
+        ("f(a)\nx := 1\ny = f(x)\n", ["ExprStmt", "Declaration", "Assignment"]),
+        ("f(a)\nx = 1\n", ["ExprStmt", "Assignment"]),
+        ("(a + b)\n\nx := (1)\n", ["ExprStmt", "Declaration"]),
+    ]
+    for text, expected in cases:
+        parser = Parser(get_tokens(text))
+        got = [type(s).__name__ for s in parser.parse().stmts]
+        if parser.err_count != 0 or got != expected:
+            raise RuntimeError(f"expected {expected}, got {got} with {parser.err_count} errors, input: {text!r}")
+
+
 @test_func
 def TestExpressionParsing():
     cases = [
         ("a + b", "EBVTVTT"),
         ("(a + b) - c", "EBGBVTVTTVTT"),
-        ("-a - -b", "EBUVTTVUTTT"),
+        ("-a - -b", "EBUVTTUVTTT"),
         ("foo(a, bar(b, c) + d)", "ECVTAVTBCVTAVTVTVTT"),
+        ("a + b - c * d % e", "EBVTBVTBVTBVTVTTTTT"),
     ]
 
     for case in cases:
@@ -61,6 +211,417 @@ def TestExpressionParsing():
         if sign != case[1]:
             raise RuntimeError(f"expected signature {case[1]}, got {sign}, input: {case[0]}")
 
+    # The splitting parser gives the same trees when there is no unary minus
+    for case in cases[:2] + cases[3:]:
+        legacy = Parser(get_tokens(case[0]), legacy_expr=True).parse()
+        sign = legacy.stmts[0].signature.short()
+        if sign != case[1]:
+            raise RuntimeError(f"expected legacy signature {case[1]}, got {sign}, input: {case[0]}")
+
+
+@test_func
+def TestBracketIndex():
+    types = [t.type for t in get_tokens("f(a[1], {b}) ] (")]
+    match, unmatched = bracket_index(types)
+    if list(match) != [-1, 10, -1, 5, -1, 3, -1, 9, -1, 7, 1, -1, -1]:
+        raise RuntimeError(f"wrong bracket index {list(match)}")
+    if unmatched != [11, 12]:
+        raise RuntimeError(f"expected unmatched brackets [11, 12], got {unmatched}")
+
+
+@test_func
+def TestLazyParsing():
+    text = 'func f(a: int): int {\n\tb := a * 2\n\treturn f(b)\n}\nf(1)\n'
+    lazy = parse_tokens(get_tokens(text), lazy=True)
+    full = parse_tokens(get_tokens(text))
+
+    func = lazy.stmts[0]
+    if func.parsed or func.name != "f" or func.params[0].name != "a":
+        raise RuntimeError("expected unparsed function f(a)")
+    if func.signature != full.stmts[0].signature or not func.parsed:
+        raise RuntimeError(f"expected signature {full.stmts[0].signature}, got {func.signature}")
+
+    # Errors in a lazy body are raised when the body is accessed
+    func = parse_tokens(get_tokens("func f(): int {\n\tb := * 2\n}\n"), lazy=True).stmts[0]
+    try:
+        func.body
+    except NeonSyntaxError as err:
+        if err.line != 2:
+            raise RuntimeError(f"expected error on line 2, got {err.line}")
+    else:
+        raise RuntimeError("expected syntax error in lazy body")
+    if func.parsed:
+        raise RuntimeError("expected body with errors to stay unparsed")
+
+
+@test_func
+def TestSignature():
+    a = parse_tokens(get_tokens("x := f(a + 1, b)\ny := f(c + 2, d)\nz := f(a, b + 1)"))
+    x, y, z = a.stmts
+    if x.signature != y.signature or x.signature == z.signature:
+        raise RuntimeError("expected signatures of x and y to equal, and differ from z")
+    if x.signature.hash() != y.signature.hash() or len(x.signature.digest) != 16:
+        raise RuntimeError("expected equal 16 byte digests")
+
+    expect = ".Declaration.Token.Call.Variable.Token.Args.Binary.Variable.Token.Literal.Token.Token.Variable.Token"
+    if str(x.signature) != expect:
+        raise RuntimeError(f"expected signature {expect}, got {x.signature}")
+
+
+@test_func
+def TestInterning():
+    tree = parse_tokens(get_tokens("x := (1 + 2) * 3\ny := (1 + 2) * 3\nz := a + (1 + 2)\nw := a + \"1\""))
+    x, y, z, w = tree.stmts
+    before = [str(s.signature) for s in tree.stmts]
+
+    interner = Interner()
+    interner.intern_tree(tree)
+    if x.expr is not y.expr or z.expr.right is not x.expr.left:
+        raise RuntimeError("expected identical subtrees to be shared")
+    if z.expr.left is w.expr.left or z.expr.right.inner.left is w.expr.right:
+        raise RuntimeError("expected variables and literals of other types not to be shared")
+    if [str(s.signature) for s in tree.stmts] != before or interner.dropped != 10 or interner.saved <= 0:
+        raise RuntimeError(f"unexpected result: {interner.report()}")
+
+
+@test_func
+def TestNodeSize():
+    tree = parse_tokens(get_tokens("x := f(a + 1)\nreturn -x"))
+    if any(hasattr(s, "__dict__") for s in tree.stmts):
+        raise RuntimeError("expected nodes without a dict")
+
+    count, size = ast.tree_size(tree)
+    if count != 9 or size <= 0:
+        raise RuntimeError(f"unexpected tree size of {count} nodes, {size} bytes")
+
+
+@test_func
+def TestArena():
+    tokens = get_token_buffer("func f(a: int): int {\n\treturn a * 2\n}\nx := f(-1, b)\n")
+    tree = parse_tokens(tokens, lazy=True)
+    arena = to_arena(tree, tokens)
+    if len(arena) != ast.tree_size(tree)[0] or list(arena.walk()) != list(range(len(arena))):
+        raise RuntimeError(f"expected {ast.tree_size(tree)[0]} nodes, got {len(arena)}")
+
+    kinds = [arena.kind(h).__name__ for h in arena.walk(arena.first_child[0])]
+    if kinds != ["Block", "Return", "Binary", "Variable", "Literal"] or arena.value(0)[0] != "f":
+        raise RuntimeError(f"wrong function body {kinds}")
+    if arena.values != [("f", [("a", tree.stmts[0].params[0].type, 3)], tree.stmts[0].return_t)]:
+        raise RuntimeError(f"expected only the function value with token indices, got {arena.values}")
+
+    copy = arena.to_tree()
+    for a, b in zip(copy.stmts, tree.stmts):
+        if a.signature != b.signature or (a.line, a.start, a.stop) != (b.line, b.start, b.stop):
+            raise RuntimeError(f"expected {b.signature} at {b.line}, got {a.signature} at {a.line}")
+    compare_tokens([copy.stmts[0].ident, copy.stmts[0].params[0].token, copy.stmts[1].ident],
+        [tree.stmts[0].ident, tree.stmts[0].params[0].token, tree.stmts[1].ident])
+
+
+@test_func
+def TestParseCache():
+    source = "x := f(a + 1)\nreturn -x\n"
+    tokens = get_token_buffer(source)
+    tree = parse_tokens(tokens)
+    with tempfile.TemporaryDirectory() as path:
+        cache = ParseCache(path)
+        if cache.load(source) is not None:
+            raise RuntimeError("expected empty cache")
+
+        cache.store(source, tree, tokens)
+        loaded = cache.load(source)
+        if loaded is None or [s.signature for s in loaded.stmts] != [s.signature for s in tree.stmts]:
+            raise RuntimeError("expected cached tree to equal parsed tree")
+        if loaded.stmts[1].string != "return -x" or cache.load(source + "\n") is not None:
+            raise RuntimeError("expected line text from source and a miss on changed source")
+
+        cache.limit = os.path.getsize(cache.file(source))
+        os.utime(cache.file(source), (0, 0))
+        cache.store(source + "y := 1\n", tree, tokens)
+        if cache.load(source) is not None or len(os.listdir(path)) != 1:
+            raise RuntimeError("expected least recently used entry to be evicted")
+
+
+@test_func
+def TestCompileDriver():
+    with tempfile.TemporaryDirectory() as path:
+        files = {"b/ok.ne": "x := f(1)\n", "a/bad.ne": "x := (1\ny := 2\n", "a/ok.ne": "y := 2\n", "a/notes.txt": ""}
+        for name, text in files.items():
+            os.makedirs(os.path.join(path, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(path, name), "w") as f:
+                f.write(text)
+
+        found = [os.path.relpath(f, path) for f in collect_files([path, os.path.join(path, "b")])]
+        if found != ["a/bad.ne", "a/ok.ne", "b/ok.ne"]:
+            raise RuntimeError(f"wrong file order {found}")
+
+        diagnostics = compile_file(os.path.join(path, "a/bad.ne"))
+        if len(diagnostics) != 1 or "a/bad.ne line 1" not in diagnostics[0]:
+            raise RuntimeError(f"expected one error in a/bad.ne, got {diagnostics}")
+        if compile_files([os.path.join(path, "a/ok.ne"), os.path.join(path, "b")], jobs=2) != 0:
+            raise RuntimeError("expected files to compile without errors")
+
+
+@test_func
+def TestBenchCorpora():
+    for name, corpus in corpora.items():
+        parser = Parser(get_token_buffer(corpus(1)))
+        parser.parse()
+        if parser.err_count != 0:
+            raise RuntimeError(f"corpus {name}: {parser.errors[0].msg}, line {parser.errors[0].line}")
+
+
+@test_func
+def TestStats():
+    text = "x := f(a + 1, (b))\ny := -x\n"
+    stats.enable()
+    stats.reset()
+    try:
+        parse_tokens(get_token_buffer(text))
+        snap = stats.snapshot()
+    finally:
+        stats.enable(False)
+        stats.reset()
+
+    if snap["counters"]["lexer.tokens"] != 18 or snap["counters"]["parser.nodes"] != 12:
+        raise RuntimeError(f"wrong counts {snap['counters']}")
+    if set(snap["times"]) != {"lex", "parse"} or snap["counters"]["parser.seek"] == 0:
+        raise RuntimeError(f"expected lex and parse phases and seeks, got {snap}")
+
+
+@test_func
+def TestMemoryReport():
+    report = memory_report("x := f(a + 1, (b))\ny := -x\n")
+    if report.tokens != 18 or report.nodes != 12:
+        raise RuntimeError(f"wrong counts {report.tokens} tokens, {report.nodes} nodes")
+    if [p for p, _, _ in report.phases] != ["lex", "parse"] or report.retained("parse") <= 0:
+        raise RuntimeError(f"expected retained lex and parse memory, got {report.phases}")
+    names = [name for name, _, _ in report.structures]
+    if names != ["token list", "line tables", "ast nodes", "signatures", "parser stacks"]:
+        raise RuntimeError(f"wrong structures {names}")
+    if "bytes per node" not in str(report):
+        raise RuntimeError("report is missing bytes per node")
+
+
+@test_func
+def TestTreePrinter():
+    out = io.StringIO()
+    parse_tokens(get_tokens("x := -f(a, 1)\n")).print(out)
+    expected = [
+        "Declaration: ", "| .name: x", "| .expr: ", "| | Unary: ", "| | | op: -", "| | | .expr: ",
+        "| | | | Call: ", "| | | | | .callee: ", "| | | | | | Variable: f", "| | | | | .inner: ",
+        "| | | | | | Args: ", "| | | | | | | | Variable: a", "| | | | | | | | Literal: 1",
+    ]
+    if out.getvalue().splitlines() != expected:
+        raise RuntimeError(f"wrong tree output {out.getvalue()!r}")
+
+    # Deeper than the recursion limit
+    expr = parse_tokens(get_tokens("1\n")).stmts[0].expr
+    for _ in range(sys.getrecursionlimit() * 2):
+        expr = ast.Group(expr)
+    tree = ast.AstNode()
+    tree.stmts = [ast.ExprStmt(expr)]
+    out = io.StringIO()
+    tree.print(out)
+    if out.getvalue().count("\n") != sys.getrecursionlimit() * 2 + 2:
+        raise RuntimeError("deep tree not fully printed")
+
+
+@test_func
+def TestVisitor():
+    class Order(ast.Visitor):
+        def __init__(self):
+            self.events = []
+
+        def visit_Binary(self, node):
+            self.events.append(("visit", node.op.lexeme, self.depth))
+            return [node.left, node.right]
+
+        def leave_Binary(self, node):
+            self.events.append(("leave", node.op.lexeme, self.depth))
+
+        def visit_Variable(self, node):
+            self.events.append(("visit", node.token.lexeme, self.depth))
+
+    order = Order()
+    order.walk(parse_tokens(get_tokens("a * b + c\n")).stmts)
+    expected = [
+        ("visit", "+", 1), ("visit", "*", 2), ("visit", "a", 3), ("visit", "b", 3),
+        ("leave", "*", 2), ("visit", "c", 2), ("leave", "+", 1),
+    ]
+    if order.events != expected:
+        raise RuntimeError(f"wrong visit order {order.events}")
+
+
+@test_func
+def TestEmitAst():
+    text = "func f(a: int, b: point): float {\n\treturn -a * 2.5\n}\nx := f(1, (y))\n"
+    tree = parse_tokens(get_tokens(text))
+    out = io.StringIO()
+    write_tree(tree, out)
+
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    kinds = [r["kind"] for r in records]
+    if kinds[-1] != "AstNode" or kinds.count("Function") != 1 or kinds.count("Literal") != 2:
+        raise RuntimeError(f"wrong records {kinds}")
+    if any(i >= n for n, r in enumerate(records) for i in r.get("children", ())):
+        raise RuntimeError("child written after its parent")
+
+    loaded = load_tree(io.StringIO(out.getvalue()), text)
+    if [s.signature.digest for s in loaded.stmts] != [s.signature.digest for s in tree.stmts]:
+        raise RuntimeError("loaded tree differs from the written tree")
+    func = loaded.stmts[0]
+    if [(p.name, p.type.string, p.type.user_def) for p in func.params] != [("a", TYPE_I32, False), ("b", "point", True)]:
+        raise RuntimeError("wrong params in loaded function")
+    if loaded.stmts[1].expr.callee.token.string != "x := f(1, (y))":
+        raise RuntimeError("loaded token does not refer to the source")
+
+
+@test_func
+def TestDefinitionScan():
+    text = (
+        "func f(a: int): int {\n\tb := a + g(1)\n\t{\n\t\tb := b * 2\n\t\tc := 0\n\t}\n\treturn b + y\n}\n"
+        "func g(x: int): int {\n\td := x\n\td := 2\n}\n"
+    )
+    tree = parse_tokens(get_tokens(text))
+    scanner = DefinitionScanner()
+    scanner.scan(tree)
+
+    f, g = tree.stmts[:2]
+    outer, block, ret = f.body.stmts
+    inner = block.stmts[0]
+    uses = {(v.token.lexeme, v.line): d for v, d in scanner.uses.items()}
+    if uses != {("a", 2): f.params[0], ("g", 2): g, ("b", 4): outer, ("b", 7): outer, ("x", 10): g.params[0]}:
+        raise RuntimeError(f"wrong definitions {uses}")
+    if [v.token.lexeme for v in scanner.unresolved] != ["y"]:
+        raise RuntimeError("expected y to be unresolved")
+
+    warnings = [(w.msg, w.line) for w in scanner.warnings]
+    expected = [
+        ("'b' shadows an outer definition", 4), ("'b' is declared but not used", 4),
+        ("'c' is declared but not used", 5),
+        ("'d' is declared but not used", 10),
+    ]
+    if warnings != expected:
+        raise RuntimeError(f"wrong warnings {warnings}")
+    if scanner.warnings[0].start != inner.ident.col:
+        raise RuntimeError("expected the inner b to shadow the outer b")
+    if [(e.msg, e.line) for e in scanner.errors] != [("'d' is already defined in this scope", 11)]:
+        raise RuntimeError(f"wrong errors {scanner.errors}")
+
+    # Duplicate functions and params are reported at their names, nested
+    # functions are defined in the scope they are in
+    text = (
+        "func f(a: int, a: int): int {\n\treturn h(a)\n\tfunc h(x: int): int {\n\t\treturn x\n\t}\n}\n"
+        "func f(): int {\n\treturn 0\n}\n"
+    )
+    tree = parse_tokens(get_tokens(text))
+    scanner = DefinitionScanner()
+    scanner.scan(tree)
+    errors = [(e.msg, e.line, e.start) for e in scanner.errors]
+    if errors != [("'f' is already defined in this scope", 7, 5), ("'a' is already defined in this scope", 1, 15)]:
+        raise RuntimeError(f"wrong errors {errors}")
+    h = tree.stmts[0].body.stmts[1]
+    if scanner.unresolved or scanner.uses[tree.stmts[0].body.stmts[0].expr.callee] is not h:
+        raise RuntimeError("expected h to be defined in f")
+
+    # Identifiers are interned by the lexer
+    names = [t.lexeme for t in get_tokens("abc := abc + abc\n") if t.type == IDENTIFIER]
+    if not names[0] is names[1] is names[2]:
+        raise RuntimeError("identifiers are not interned")
+
+
+@test_func
+def TestTypeCheck():
+    text = (
+        "func f(a: int, b: float): float {\n\tc := a + 1\n\td := float(c) + b\n\te := 1 + 1.0\n\treturn d\n}\n"
+        "func g(): int {\n\tx := f(1)\n\ty := \"s\" + \"t\"\n\ty = -true\n\treturn f(1, 2.0)\n}\n"
+    )
+    tree = parse_tokens(get_tokens(text))
+    checker = TypeChecker()
+    errors = [(e.msg, e.line) for e in checker.check(tree)]
+    expected = [
+        ("mismatched types int and float", 4), ("'f' takes 2 arguments, got 1", 8),
+        ("operator '-' is not defined for bool", 10), ("mismatched types int and float in return of 'g'", 11),
+    ]
+    if errors != expected:
+        raise RuntimeError(f"wrong errors {errors}")
+
+    body = tree.stmts[0].body.stmts
+    if [s.type.type for s in body[:3]] != [TYPE_I32, TYPE_F32, TYPE_ANY] or body[1].expr.left.type.type != TYPE_F32:
+        raise RuntimeError(f"wrong types {[s.type.string for s in body[:3]]}")
+
+    # Checking again reuses every statement
+    if [(e.msg, e.line) for e in checker.check(tree)] != expected or checker.checked != 0:
+        raise RuntimeError(f"expected all statements reused, {checker.checked} checked")
+
+    # A replaced statement and the statements that use its name are checked
+    body[0] = parse_tokens(get_tokens("c := 1.5\n")).stmts[0]
+    checker.check(tree)
+    if checker.checked != 2 or checker.reused != len(checker.memo) - 2 or body[1].expr.left.type.type != TYPE_F32:
+        raise RuntimeError(f"expected 2 statements checked, got {checker.checked}")
+
+    # Parsing the source again, with a line added above, reuses every
+    # statement of the first check and moves its errors
+    checker = TypeChecker()
+    checker.check(parse_tokens(get_tokens(text)))
+    tree = parse_tokens(get_tokens("\n" + text))
+    errors = [(e.msg, e.line) for e in checker.check(tree)]
+    if errors != [(msg, line + 1) for msg, line in expected] or checker.checked != 0:
+        raise RuntimeError(f"expected all statements reused, {checker.checked} checked, errors {errors}")
+    body = tree.stmts[0].body.stmts
+    if [s.type.type for s in body[:3]] != [TYPE_I32, TYPE_F32, TYPE_ANY] or body[1].expr.left.type.type != TYPE_F32:
+        raise RuntimeError(f"wrong reused types {[s.type.string for s in body[:3]]}")
+
+    # Editing a token in place checks its statement and the ones using it
+    tok = body[0].expr.right.token
+    tok.lexeme, tok.isfloat = "1.5", True
+    errors = [(e.msg, e.line) for e in checker.check(tree)]
+    if checker.checked != 2 or errors[0] != ("mismatched types int and float", 3) or body[0].type is not ANY:
+        raise RuntimeError(f"expected edited statement checked, {checker.checked} checked, errors {errors}")
+
+    # Appending a line or editing the last one checks only that statement
+    text = "a := 1\nb := a + 2\nc := b * 3\nd := 1.5\ne := d + 1.0\n"
+    checker = TypeChecker()
+    checker.check(parse_tokens(get_tokens(text)))
+    for edited, reused in ((text + "f := e\n", 5), (text[:-4] + "2.0\n", 4)):
+        checker.check(parse_tokens(get_tokens(edited)))
+        if checker.checked != 1 or checker.reused != reused:
+            raise RuntimeError(f"expected 1 statement checked, got {checker.checked} checked and {checker.reused} reused")
+
+
+@test_func
+def TestConstantFolding():
+    text = (
+        "func f(): int {\n\ta := 2 * (3 + 1) - -1\n\tb := 0.1 + 0.2\n\tc := f64(0.5) + f64(0.25)\n"
+        "\td := \"ab\" + \"c\" == \"abc\" && !false\n\te := -7 / 2 + -7 % 2\n\tg := i8(-128)\n"
+        "\th := u8(200) + u8(100)\n\ti := 1 / 0\n\tk := 1.0 / 0.0\n\tj := a + 1\n\treturn a\n}\n"
+    )
+    tree = parse_tokens(get_tokens(text))
+    checker = TypeChecker()
+    checker.check(tree)
+    errors = [(e.msg, e.line) for e in ConstantFolder().fold(tree)]
+    if errors != [("constant overflows u8", 8), ("division by zero in constant expression", 9)]:
+        raise RuntimeError(f"wrong errors {errors}")
+
+    folded = {}
+    for s in tree.stmts[0].body.stmts[:-1]:
+        if type(s.expr) == ast.Literal:
+            folded[s.ident.lexeme] = (s.expr.token.lexeme, s.expr.type.type)
+    expected = {
+        "a": ("9", TYPE_I32), "b": ("0.3", TYPE_F32), "c": ("0.75", TYPE_F64),
+        "d": ("true", TYPE_BOOL), "e": ("-4", TYPE_I32), "g": ("-128", TYPE_I8),
+    }
+    if folded != expected:
+        raise RuntimeError(f"wrong folds {folded}")
+    # Float division by zero is not an error and is not folded
+    if type(tree.stmts[0].body.stmts[8].expr) != ast.Binary:
+        raise RuntimeError("expected float division by zero to be left unfolded")
+
+    # Only statements with folds are checked again, h has its casts folded.
+    # Folded literals keep their types.
+    if checker.check(tree) or checker.checked != 7 or tree.stmts[0].body.stmts[5].type.type != TYPE_I8:
+        raise RuntimeError(f"expected 7 statements checked again, got {checker.checked}")
+
 
 @test_func
 def TestStatementParsing():
@@ -1,12 +1,118 @@
-from hashlib import sha256
+import sys
+from hashlib import blake2b
+from array import array
+from bisect import bisect_right
+import re
+
+newline_pattern = re.compile("\n")
+
+# Start offsets of each line in a source string. Built once per file so
+# tokens and errors only need to keep a line number and column, the line
+# text is sliced out when it is actually needed.
+#
+# Edits replace whole lines. On the first edit the source is split into
+# line strings and src is only joined again when asked for. Starts from
+# index moved on are stored without the length change delta of the edits
+# before them, so an edit only fixes the starts between it and the previous
+# edit instead of every start after it.
+class LineTable:
+    def __init__(self, src: str, first: int = 1):
+        self._src = src
+        self.rows = None   # Text of each line with its newline, once edited
+        self.first = first # Line number of the first line in src
+        self.size = len(src)
+        self.starts = [0]
+        self.starts.extend(m.end() for m in newline_pattern.finditer(src))
+        self.moved = len(self.starts)
+        self.delta = 0
+
+    @property
+    def src(self) -> str:
+        if self._src is None:
+            self._src = "".join(self.rows)
+        return self._src
+
+    # Returns the source offset of the line at index idx
+    def start(self, idx: int) -> int:
+        if idx >= self.moved:
+            return self.starts[idx] + self.delta
+        return self.starts[idx]
+
+    # Returns the index of the line the source offset is on
+    def index(self, offset: int) -> int:
+        starts, moved = self.starts, self.moved
+        if moved < len(starts) and offset >= starts[moved] + self.delta:
+            return bisect_right(starts, offset - self.delta, moved) - 1
+        return bisect_right(starts, offset, 0, moved) - 1
+
+    # Returns the text of the lines at index first to last, with newlines
+    def span(self, first: int, last: int) -> str:
+        if self.rows is not None:
+            return "".join(self.rows[first:last+1])
+        end = self.starts[last+1] if last+1 < len(self.starts) else self.size
+        return self._src[self.starts[first]:end]
+
+    # Replaces the lines at index first to last with the text, which ends
+    # with a newline unless it replaces the last line
+    def replace(self, first: int, last: int, text: str):
+        if self.rows is None:
+            starts = self.starts
+            self.rows = [self._src[a:b] for a, b in zip(starts, starts[1:] + [self.size])]
+        parts = text.split("\n")
+        rows = [r + "\n" for r in parts[:-1]]
+        if last+1 == len(self.starts):
+            rows.append(parts[-1])
+
+        # Move the stale starts boundary to the line after the edit
+        start = self.start(first)
+        starts, moved, delta = self.starts, self.moved, self.delta
+        if delta != 0:
+            for i in range(moved, first):
+                starts[i] += delta
+            for i in range(last+1, moved):
+                starts[i] -= delta
+
+        region = [start]
+        for r in rows[:-1]:
+            region.append(region[-1] + len(r))
+        change = len(text) - len(self.span(first, last))
+        starts[first:last+1] = region
+        self.rows[first:last+1] = rows
+        self.moved = first + len(rows)
+        self.delta = delta + change
+        self.size += change
+        self._src = None
+
+    # Returns the text of the given line, without the newline
+    def text(self, line: int) -> str:
+        idx = line - self.first
+        if idx < 0 or idx >= len(self.starts):
+            return ""
+        if self.rows is not None:
+            row = self.rows[idx]
+            return row[:-1] if row.endswith("\n") else row
+        start = self.starts[idx]
+        if idx+1 < len(self.starts):
+            return self._src[start:self.starts[idx+1]-1]
+        return self._src[start:]
+
+    # Returns the source offset of the given line and column
+    def offset(self, line: int, col: int) -> int:
+        return self.start(line - self.first) + col
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
 
 class Token:
+    __slots__ = ("type", "lexeme", "line", "col", "lines", "kind", "isfloat")
+
     def __init__(self,
             typ: int,             # Token type
             lexeme: str,          # Token text lexeme
             line: int,            # Line number
             col: int,             # Column
-            string: str,          # Line token is at as a string
+            lines: LineTable,     # Line table of the tokens source
             kind: str,            # Token type kind
             isfloat: bool = False # If token is float
         ):
@@ -14,45 +120,200 @@ class Token:
         self.lexeme  = lexeme
         self.line    = line
         self.col     = col
-        self.string  = string
+        self.lines   = lines
         self.kind    = kind
         self.isfloat = isfloat
 
+    # Line token is at as a string
+    @property
+    def string(self) -> str:
+        return self.lines.text(self.line)
+
+    # Pickled as constructor arguments, which is smaller than slot state
+    def __reduce__(self):
+        return (Token, (self.type, self.lexeme, self.line, self.col, self.lines, self.kind, self.isfloat))
+
+
+# Token flags stored in TokenBuffer
+FLAG_FLOAT = 1
+
+# Compact token list. Token fields are stored in parallel array columns and
+# the lexeme is sliced from the source, so a buffered token costs a couple
+# dozen bytes instead of a full object. Token objects are created on demand
+# when indexing or iterating.
+class TokenBuffer:
+    def __init__(self, src: str, lines: LineTable):
+        self.src      = src
+        self.lines    = lines
+        self.types    = array("B") # Token type
+        self.starts   = array("q") # Source offset of token text
+        self.lengths  = array("I") # Length of token text
+        self.line_nos = array("I") # Line number
+        self.cols     = array("I") # Column
+        self.flags    = array("B") # Token flags (FLAG_FLOAT)
+
+    def append(self, typ: int, start: int, length: int, line: int, col: int, flags: int = 0):
+        self.types.append(typ)
+        self.starts.append(start)
+        self.lengths.append(length)
+        self.line_nos.append(line)
+        self.cols.append(col)
+        self.flags.append(flags)
+
+    # Returns the lexeme of token i. Strings do not include the quotes.
+    # Identifiers are interned, so every use of a name shares one string and
+    # symbol tables compare names by identity with a cached hash.
+    def lexeme(self, i: int) -> str:
+        typ = self.types[i]
+        if typ == NEWLINE:
+            return "NEWLINE"
+        start = self.starts[i]
+        if typ == STRING:
+            return self.src[start+1:start+self.lengths[i]-1]
+        if typ == IDENTIFIER:
+            return sys.intern(self.src[start:start+self.lengths[i]])
+        return self.src[start:start+self.lengths[i]]
+
+    # Creates the Token object for token i
+    def token(self, i: int) -> Token:
+        typ = self.types[i]
+        return Token(typ, self.lexeme(i), self.line_nos[i], self.cols[i], self.lines,
+            token_kinds.get(typ, KIND_NONE), self.flags[i] & FLAG_FLOAT != 0)
+
+    # Creates Token objects for the whole buffer
+    def tokens(self) -> list[Token]:
+        src, lines, intern = self.src, self.lines, sys.intern
+        tokens = []
+        append = tokens.append
+        columns = zip(self.types, self.starts, self.lengths, self.line_nos, self.cols, self.flags)
+        for typ, start, length, line, col, flags in columns:
+            if typ == NEWLINE:
+                lexeme = "NEWLINE"
+            elif typ == STRING:
+                lexeme = src[start+1:start+length-1]
+            elif typ == IDENTIFIER:
+                lexeme = intern(src[start:start+length])
+            else:
+                lexeme = src[start:start+length]
+            append(Token(typ, lexeme, line, col, lines, token_kinds.get(typ, KIND_NONE), flags & FLAG_FLOAT != 0))
+        return tokens
+
+    def __len__(self) -> int:
+        return len(self.types)
 
+    def __getitem__(self, i):
+        if type(i) == slice:
+            return [self.token(j) for j in range(*i.indices(len(self.types)))]
+        if i < 0:
+            i += len(self.types)
+        if i < 0 or i >= len(self.types):
+            raise IndexError("token index out of range")
+        return self.token(i)
+
+    def __iter__(self):
+        for i in range(len(self.types)):
+            yield self.token(i)
+
+
+# Digest of each signature tag, tags repeat a lot so they are cached
+tag_digests = {}
+
+def tag_digest(tag: str) -> bytes:
+    if (d := tag_digests.get(tag)) is None:
+        d = tag_digests[tag] = blake2b(tag.encode("utf-8"), digest_size=16).digest()
+    return d
+
+# Structural signature of a parse node. Stores the node's own tags and
+# references to its children, and combines them into a fixed size Merkle
+# digest on first use. Comparing two signatures compares digests only. The
+# readable string is built from the parts when requested.
 class Signature:
+    __slots__ = ("parts", "_digest")
+
     def __init__(self, some: object = None):
-        self.sign = ""
+        self.parts = []
+        self._digest = None
         if some:
             self.add(some)
     
     def add(self, some: object):
-        if hasattr(some, "signature"):
-            self.add(some.signature)
+        # Checks the class first so a deferred signature is not evaluated
+        if hasattr(type(some), "signature") or hasattr(some, "signature") or type(some) == Signature:
+            self.parts.append(some)
         elif type(some) == list:
             for n in some:
                 self.add(n)
-        elif type(some) == Signature:
-            self.sign += f"{some.sign}"
         elif type(some) == str:
-            self.sign += f".{some}"
+            self.parts.append(some)
         else:
-            self.sign += f".{type(some).__name__}"
-    
-    # Returns the sha256 hexadecimal value of the signature
+            self.parts.append(type(some).__name__)
+        self._digest = None
+
+    # Drops the cached digest after parts were replaced
+    def changed(self):
+        self._digest = None
+
+    # Signatures of children, resolved when needed so deferred nodes are
+    # only parsed when their signature is used
+    def children(self):
+        for p in self.parts:
+            if type(p) == str:
+                yield p
+            elif type(p) == Signature:
+                yield p
+            else:
+                yield p.signature
+
+    # Digest of the tags and child digests
+    @property
+    def digest(self) -> bytes:
+        if self._digest is None:
+            # Compute child digests bottom up without recursion
+            stack = [self]
+            while stack:
+                sig = stack[-1]
+                pending = [c for c in sig.children() if type(c) == Signature and c._digest is None]
+                if pending:
+                    stack.extend(pending)
+                    continue
+
+                stack.pop()
+                h = blake2b(digest_size=16)
+                for c in sig.children():
+                    h.update(tag_digest(c) if type(c) == str else c._digest)
+                sig._digest = h.digest()
+
+        return self._digest
+
+    # Returns the hexadecimal value of the signature digest
     def hash(self) -> str:
-        return sha256(self.sign.encode("utf-8")).hexdigest()
+        return self.digest.hex()
     
     # Returns the short representation of the signature
     def short(self) -> str:
-        s = self.sign.split(".")
+        s = str(self).split(".")
         t = [c[0].upper() if len(c) != 0 else "" for c in s]
         return "".join(t)
     
+    # Full signature string, the tags of the subtree in order
     def __str__(self) -> str:
-        return self.sign
+        tags = []
+        stack = [iter([self])]
+        while stack:
+            c = next(stack[-1], None)
+            if c is None:
+                stack.pop()
+            elif type(c) == str:
+                tags.append(f".{c}")
+            else:
+                stack.append(c.children())
+        return "".join(tags)
 
     def __eq__(self, __value: object) -> bool:
-        return self.sign == __value.sign
+        return self.digest == __value.digest
+
+    def __hash__(self) -> int:
+        return int.from_bytes(self.digest[:8], "little")
     
 
 _i = 0
@@ -196,6 +457,12 @@ kind_to_types = {
     KIND_NONE: [TYPE_NONE, TYPE_NULL],
 }
 
+# Kind of token types that are not KIND_NONE
+token_kinds = {
+    NUMBER: KIND_NUMBER,
+    STRING: KIND_STRING,
+}
+
 type_to_kind = {}
 for k, v in kind_to_types.items():
     for t in v: type_to_kind[t] = k
@@ -269,6 +536,14 @@ double_symbol_lookup = {
     # "<<": BIT_LSHIFT,
 }
 
+bracket_pairs = {
+    LEFT_PAREN: RIGHT_PAREN,
+    LEFT_SQUARE: RIGHT_SQUARE,
+    LEFT_BRACE: RIGHT_BRACE,
+}
+
+bracket_closers = {v: k for k, v in bracket_pairs.items()}
+
 binary_ops = (
     AND,
     OR,
@@ -285,11 +560,25 @@ binary_ops = (
     MODULO,
 )
 
+# Binding power of binary operators. Each operator is its own level,
+# binary_ops goes from the loosest to the tightest binding.
+binary_precedence = {op: i for i, op in enumerate(binary_ops)}
+
 unary_ops = (
     MINUS,
     NOT,
 )
 
+# Token types that are parsed as literal expressions
+literal_types = (
+    NUMBER,
+    STRING,
+    CHAR,
+    TRUE,
+    FALSE,
+    NULL,
+)
+
 whitespace_lookup = {
     " ": SPACE,
     "\n": NEWLINE,
@@ -4,6 +4,10 @@ import os
 if os.name == "nt":
     os.system("color")
 
+# Compiler version, bump when the syntax tree changes. Part of the parse
+# cache key, so cached trees from other versions are not loaded.
+version = "0.1.3"
+
 def err(msg: str):
     print(f"{red('error: ')}{msg}")
     exit(1)